@@ -0,0 +1,69 @@
+"""Background reader that fetches data ahead of the simulation clock"""
+import threading
+import queue
+
+
+class Prefetcher(object):
+    """Calls fetch(key) on a background thread for each key, in order, ahead of the consumer.
+
+    At most `depth` results wait in the queue, so the reader blocks instead of running further ahead.
+    Keys must be increasing. get(key) drops results for keys already passed, and falls back to
+    calling fetch directly for a key that was not prefetched.
+    """
+    DONE = object()
+
+    def __init__(self, fetch, keys, depth=10):
+        self.fetch = fetch
+        self.lock = threading.Lock()        # fetch is never run by both threads at once
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.pending = None
+        self.finished = False
+        self.thread = threading.Thread(target=self.run, args=(iter(keys),), daemon=True)
+        self.thread.start()
+
+    def run(self, keys):
+        for key in keys:
+            if self.stopped.is_set():
+                return
+            try:
+                with self.lock:
+                    item = (key, self.fetch(key), None)
+            except Exception as e:
+                item = (key, None, e)
+            if not self.put(item):
+                return
+        self.put(self.DONE)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, key):
+        while not self.finished:
+            if self.pending is None:
+                item = self.queue.get()
+                if item is self.DONE:
+                    self.finished = True
+                    break
+                self.pending = item
+            k, value, error = self.pending
+            if k > key:
+                break
+            self.pending = None
+            if k == key:
+                if error is not None:
+                    raise error
+                return value
+        with self.lock:
+            return self.fetch(key)
+
+    # The reader notices within one put timeout, or once the fetch in progress returns
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,51 @@
+"""Disk cache for lookup tables that are expensive to build at startup"""
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+
+def make_key(*parts):
+    """Short digest of the settings a table depends on"""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Content hash of a file, for tables derived from data files"""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def write_atomically(path, write):
+    """Write a file through write(f) into a temporary file of its own, then move it to path, so that processes
+    building the same table at the same time never read or replace a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=os.path.splitext(path)[1] + ".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_or_build(path, build):
+    """Load the array cached at path (.npy), or build it and cache it"""
+    if os.path.exists(path):
+        return np.load(path)
+    array = build()
+    write_atomically(path, lambda f: np.save(f, array))
+    return array
+
+
+def load_or_build_many(path, build):
+    """Same as load_or_build for a dict of arrays, cached as .npz"""
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+    arrays = build()
+    write_atomically(path, lambda f: np.savez(f, **arrays))
+    return arrays
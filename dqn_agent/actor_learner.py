@@ -0,0 +1,99 @@
+import queue
+from config.settings import GLOBAL_STATE_UPDATE_CYCLE, TIMESTEP
+from dqn_agent.dqn_policy import DQNDispatchPolicy, DQNDispatchPolicyLearner
+from dqn_agent.q_network import ActorDeepQNetwork
+from dqn_agent.replay_memory import ReplayMemory
+from simulator import settings
+from simulator.settings import FLAGS
+
+
+# Collects experience in a simulator process and sends it to the learner once per global state update,
+# together with the supply demand maps of that update. Training happens in the learner only.
+class ActorDispatchPolicy(DQNDispatchPolicyLearner):
+    def __init__(self, experience_queue, weight_queue):
+        super().__init__()
+        # At most one transition per vehicle and step between two updates
+        self.experience_memory = ReplayMemory(FLAGS.vehicles * int(GLOBAL_STATE_UPDATE_CYCLE / TIMESTEP))
+        self.memory_writer = None      # The learner keeps the experience
+        self.experience_queue = experience_queue
+        self.weight_queue = weight_queue
+
+    # Starts from the learner's weights, which include any network it loaded
+    def build_q_network(self, load_network=None):
+        self.q_network = ActorDeepQNetwork()
+        self.load_weights(self.weight_queue.get())
+
+    def dispatch(self, current_time, vehicles):
+        self.give_rewards(vehicles)
+        dispatch_commands = DQNDispatchPolicy.dispatch(self, current_time, vehicles)
+        self.backup_supply_demand()
+        return dispatch_commands
+
+    def backup_supply_demand(self):
+        current_time = self.feature_constructor.get_current_time()
+
+        if current_time % GLOBAL_STATE_UPDATE_CYCLE == 0:
+            self.update_weights()
+            f = self.q_network.get_fingerprint()
+            self.feature_constructor.update_fingerprint(f)
+            experience = self.experience_memory.get(self.experience_memory.ordered_index())
+            self.experience_memory.clear()
+            self.experience_queue.put((current_time, self.feature_constructor.get_raw_supply_demand_maps(), f, experience))
+
+    # Load the latest weights and fingerprint sent by the learner, if any
+    def update_weights(self):
+        try:
+            message = self.weight_queue.get_nowait()
+        except queue.Empty:
+            return
+        self.load_weights(message)
+
+    def load_weights(self, message):
+        weights, (n_steps, epsilon) = message
+        self.q_network.set_weights(weights)
+        self.q_network.n_steps, self.q_network.epsilon = n_steps, epsilon
+
+
+# Replaces any weights the actor has not loaded yet
+def broadcast_weights(q_network, weight_queues):
+    message = q_network.get_weights(), q_network.get_fingerprint()
+    for weight_queue in weight_queues:
+        try:
+            weight_queue.get_nowait()
+        except queue.Empty:
+            pass
+        weight_queue.put(message)
+
+
+def receive_experience(learner, message):
+    t, sd, f, experience = message
+    # Transitions first, a shard is written with the snapshot that follows them
+    if len(experience['t']) > 0:
+        learner.experience_memory.extend(**experience)
+        learner.memory_writer.extend(**experience)
+    learner.memorize_supply_demand(t, sd, f)
+
+
+# Trains the learner on the experience of n_actors ActorDispatchPolicy until they all finish
+def run_learner(learner, experience_queue, weight_queues, n_actors):
+    broadcast_weights(learner.q_network, weight_queues)
+    n_running = n_actors
+    while n_running > 0:
+        training = len(learner.supply_demand_history) > settings.INITIAL_MEMORY_SIZE
+        # Wait for experience until there is enough to train on, then take only what has arrived
+        try:
+            message = experience_queue.get(block=not training)
+            while True:
+                if message is None:
+                    n_running -= 1
+                else:
+                    receive_experience(learner, message)
+                message = experience_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+        if training:
+            average_loss, average_q_max = learner.train_network(FLAGS.batch_size)
+            learner.q_network.write_summary(average_loss, average_q_max)
+            if learner.q_network.n_steps % settings.ACTOR_UPDATE_INTERVAL == 0:
+                broadcast_weights(learner.q_network, weight_queues)
@@ -3,9 +3,12 @@ import os
 import numpy as np
 from collections import OrderedDict, defaultdict
 from simulator.settings import FLAGS
-from config.settings import GLOBAL_STATE_UPDATE_CYCLE, MIN_DISPATCH_CYCLE
+from config.settings import GLOBAL_STATE_UPDATE_CYCLE, MIN_DISPATCH_CYCLE, MAP_WIDTH, MAP_HEIGHT
 from dqn_agent.feature_constructor import FeatureConstructor
 from dqn_agent.q_network import DeepQNetwork, FittingDeepQNetwork
+from dqn_agent.replay_memory import ReplayMemory
+from dqn_agent.supply_demand_history import SupplyDemandHistory
+from dqn_agent.memory_store import MemoryShardWriter, iter_shards, list_shards
 from dummy_agent.dispatch_policy import DispatchPolicy
 from simulator import settings
 from common.time_utils import get_local_datetime
@@ -37,6 +40,7 @@ class DQNDispatchPolicy(DispatchPolicy):
 
     # Overriding the parent function in dummy_agent.dispatch_policy
     def get_dispatch_decisions(self, tbd_vehicles):
+        self.prefetch_q_values(tbd_vehicles)
         dispatch_commands = []
         for vehicle_id, vehicle_state in tbd_vehicles.iterrows():
             # Get best action for this vehicle and whether it will be offduty or not
@@ -76,13 +80,7 @@ class DQNDispatchPolicy(DispatchPolicy):
                 # Calculate Q values based on state features
                 Q = self.q_network.compute_q_values(s)
                 # print("Q values: ", Q)
-                # only considers actions whose values are greater than wait action value
-                wait_action_value = Q[0]
-                actions = [a for a, q in zip(actions, Q) if q >= wait_action_value]
-                Q = Q[Q >= wait_action_value]
-                # print("Q ba: ", Q)
-                amax = np.argmax(Q)     # Get the index of the max value
-                # print("Q max, val, max: ", amax, Q[amax], max(Q))
+                actions, Q, amax = self.select_actions(actions, Q)
                 self.q_cache[(x, y)] = actions, Q, amax     # Save in cache
             # if actions[amax] == (0, 0):
             #     aidx = amax
@@ -101,6 +99,27 @@ class DQNDispatchPolicy(DispatchPolicy):
             # print("Added:", vehicle.q_action_dict)
         return a, offduty
 
+    # Only considers actions whose values are greater than wait action value
+    def select_actions(self, actions, Q):
+        wait_action_value = Q[0]
+        actions = [a for a, q in zip(actions, Q) if q >= wait_action_value]
+        Q = Q[Q >= wait_action_value]
+        amax = np.argmax(Q)     # Get the index of the max value
+        return actions, Q, amax
+
+    # Fill q_cache for all the cells the vehicles are in with a single forward pass
+    def prefetch_q_values(self, tbd_vehicles):
+        if self.q_network is None or len(tbd_vehicles) == 0:
+            return
+        xs, ys = mesh.lon2X(tbd_vehicles.lon.values), mesh.lat2Y(tbd_vehicles.lat.values)
+        cells = [l for l in OrderedDict.fromkeys(zip(xs.tolist(), ys.tolist())) if l not in self.q_cache]
+        if len(cells) == 0:
+            return
+        sa, sizes, cell_actions = self.feature_constructor.construct_current_features_batch(cells)
+        Qs = self.q_network.compute_q_values_batch(sa, sizes)
+        for l, actions, Q in zip(cells, cell_actions, Qs):
+            self.q_cache[l] = self.select_actions(actions, Q)
+
     # Get the destination from dispatched vehicles
     def convert_action_to_destination(self, vehicle_state, a):
         cache_key = None
@@ -122,8 +141,14 @@ class DQNDispatchPolicy(DispatchPolicy):
 class DQNDispatchPolicyLearner(DQNDispatchPolicy):
     def __init__(self):
         super().__init__()
-        self.supply_demand_history = OrderedDict()
-        self.experience_memory = []
+        self.supply_demand_history = SupplyDemandHistory(int(settings.NUM_SUPPLY_DEMAND_HISTORY),
+                                                         settings.NUM_SUPPLY_DEMAND_MAPS, (MAP_WIDTH, MAP_HEIGHT),
+                                                         self.feature_constructor.expand_supply_demand_maps,
+                                                         int(settings.SUPPLY_DEMAND_CACHE_SIZE))
+        self.experience_memory = ReplayMemory(settings.MAX_MEMORY_SIZE)
+        self.memory_writer = MemoryShardWriter(FLAGS.save_memory_dir, settings.NUM_SUPPLY_DEMAND_MAPS,
+                                               (MAP_WIDTH, MAP_HEIGHT))
+        self.pending_shards = iter([])
         self.last_state_actions = {}
         self.rewards = defaultdict(int)
         self.last_earnings = defaultdict(int)
@@ -136,25 +161,41 @@ class DQNDispatchPolicyLearner(DQNDispatchPolicy):
         self.last_earnings = defaultdict(int)
         self.last_cost = defaultdict(int)
 
-    # Store memory
+    # Store memory, the shards are written while experience is collected so only the last one is left
     def dump_experience_memory(self):
-        sd_path = os.path.join(FLAGS.save_memory_dir, "sd_history.pkl")
-        sars_path = os.path.join(FLAGS.save_memory_dir, "sars_history.pkl")
-        pickle.dump(self.supply_demand_history, open(sd_path, "wb"))
-        pickle.dump(self.experience_memory, open(sars_path, "wb"))
+        self.memory_writer.flush()
 
-    # Load stored memory
+    # Load stored memory. Shards are read one at a time: enough to start training now, the rest by train_network
     def load_experience_memory(self, path):
-        sd_path = os.path.join(path, "sd_history.pkl")
-        sars_path = os.path.join(path, "sars_history.pkl")
-        self.supply_demand_history = pickle.load(open(sd_path, "rb"))
-        self.experience_memory = pickle.load(open(sars_path, "rb"))
+        shards = list_shards(path)
+        if shards:
+            print("memory shards: {}".format(len(shards)))
+            self.pending_shards = iter_shards(path)
+            while len(self.supply_demand_history) <= settings.INITIAL_MEMORY_SIZE and self.load_next_shard():
+                pass
+            return
+
+        # Older dumps pickle all the maps of each snapshot, the raw maps come first, and a list of transitions
+        sd_history = pickle.load(open(os.path.join(path, "sd_history.pkl"), "rb"))
+        for t, (sd, f) in sd_history.items():
+            self.supply_demand_history.add(t, np.asarray(sd[:settings.NUM_SUPPLY_DEMAND_MAPS]), f)
+        experience = pickle.load(open(os.path.join(path, "sars_history.pkl"), "rb"))
+        self.experience_memory = ReplayMemory.from_experience(experience, settings.MAX_MEMORY_SIZE)
         # print(len(self.experience_memory))
-        state_action, _, _ = self.experience_memory[0]
-        t_start, _, _ = state_action
-        state_action, _, _ = self.experience_memory[-1]
-        t_end, _, _ = state_action
-        print("period: {} ~ {}".format(get_local_datetime(t_start), get_local_datetime(t_end)))
+        t = self.experience_memory.columns['t'][self.experience_memory.ordered_index()]
+        print("period: {} ~ {}".format(get_local_datetime(t[0]), get_local_datetime(t[-1])))
+
+    # Returns False when no shards are left
+    def load_next_shard(self):
+        shard = next(self.pending_shards, None)
+        if shard is None:
+            return False
+        sd, sars = shard
+        for t, f, raw_sd in zip(sd['t'].tolist(), sd['fingerprint'], sd['maps']):
+            self.supply_demand_history.add(t, raw_sd, f)
+        if len(sars) > 0:
+            self.experience_memory.extend(**{name: sars[name] for name in sars.dtype.names})
+        return True
 
 
     def build_q_network(self, load_network=None):
@@ -211,16 +252,18 @@ class DQNDispatchPolicyLearner(DQNDispatchPolicy):
             f = self.q_network.get_fingerprint()
             self.feature_constructor.update_fingerprint(f)
             # Load supply demand maps with fingerprint
-            self.supply_demand_history[current_time] = self.feature_constructor.get_supply_demand_maps(), f
+            self.memorize_supply_demand(current_time, self.feature_constructor.get_raw_supply_demand_maps(), f)
 
-            if len(self.supply_demand_history) > settings.NUM_SUPPLY_DEMAND_HISTORY:
-                self.supply_demand_history.popitem(last=False)
+    # Keeps the raw maps only, the oldest snapshot is dropped once the history is full
+    def memorize_supply_demand(self, t, raw_sd, f):
+        self.supply_demand_history.add(t, raw_sd, f)
+        self.memory_writer.add_snapshot(t, raw_sd, f)
 
     # Replay when needed (Returns map and fingerprint)
     def replay_supply_demand(self, t):
         t_ = t - (t % GLOBAL_STATE_UPDATE_CYCLE)
         if t_ in self.supply_demand_history:
-            return self.supply_demand_history[t_]
+            return self.supply_demand_history.get(t_)
         else:
             return None, None
 
@@ -230,12 +273,11 @@ class DQNDispatchPolicyLearner(DQNDispatchPolicy):
         last_state_action = self.last_state_actions.get(vehicle_id, None)       # Load last action
 
         if last_state_action is not None:
-            current_state = (t, l)
+            last_t, (last_x, last_y), (ax, ay) = last_state_action
             reward = self.rewards[vehicle_id]
-
-            if len(self.experience_memory) > settings.MAX_MEMORY_SIZE:
-                self.experience_memory.pop(0)
-            self.experience_memory.append((last_state_action, current_state, reward))
+            self.experience_memory.append(last_t, last_x, last_y, ax, ay, t, l[0], l[1], reward)
+            if self.memory_writer is not None:
+                self.memory_writer.append(last_t, last_x, last_y, ax, ay, t, l[0], l[1], reward)
 
         self.rewards[vehicle_id] = 0    # Reset reward
         self.last_state_actions[vehicle_id] = (t, l, a)     # Update last action
@@ -243,48 +285,62 @@ class DQNDispatchPolicyLearner(DQNDispatchPolicy):
     def train_network(self, batch_size, n_iterations=1):
         loss_sum = 0
         q_max_sum = 0
+        self.load_next_shard()
         for _ in range(n_iterations):
-            sa_batch = []
-            y_batch = []
-            for _ in range(batch_size):
-                sa, y = self.replay_memory()    # Get state and action features, with the reward
-                sa_batch.append(sa)
-                y_batch.append(y)
-
+            sa_batch, y_batch = self.replay_memory(batch_size)  # Get state and action features, with the targets
             loss_sum += self.q_network.fit(sa_batch, y_batch)   # Train model
             q_max_sum += np.mean(y_batch)
         self.q_network.run_cyclic_updates()     # Update target network
         return loss_sum / n_iterations, q_max_sum / n_iterations
 
-    # Replay when needed, returns State features and action features along with reward
-    def replay_memory(self, max_retry=100):
+    # Samples transitions that can be replayed, invalidating the others.
+    # Returns their columns from the replay memory, see ReplayMemory.COLUMNS
+    def sample_experience(self, batch_size, max_retry=100):
+        sampled = []
+        n_sampled = 0
+        history = np.fromiter(self.supply_demand_history.keys(), dtype=np.int64)
         for _ in range(max_retry):
-            num = np.random.randint(0, len(self.experience_memory) - 1)
-            state_action, next_state, reward = self.experience_memory[num]
-            tm, Loc, act = state_action
-            next_t, next_l = next_state
-            if self.feature_constructor.reachable_map[next_l] == 0:
-                self.experience_memory.pop(num)
-                continue
-            sd, f = self.replay_supply_demand(tm)   # Get supply demand map, and fingerprint
-            if sd is None:
-                self.experience_memory.pop(num)
-                continue
-            next_sd, next_f = self.replay_supply_demand(next_t) # Get supply demand map, and fingerprint
-            if next_sd is None:
-                self.experience_memory.pop(num)
-                continue
-            a_feature = self.feature_constructor.construct_action_feature(tm, Loc, sd, act)
-            if a_feature is None:
-                self.experience_memory.pop(num)
-                continue
-
-            s_feature = self.feature_constructor.construct_state_feature(tm, f, Loc, sd)
-            sa = s_feature + a_feature      # State features and action features
-            next_sa, _ = self.feature_constructor.construct_features(next_t, next_f, next_l, next_sd)
-            target_value = self.q_network.compute_target_value(next_sa)
-            discount_factor = settings.GAMMA ** int((next_t - tm) / 60)
-            y = reward + discount_factor * target_value
-            return sa, y
-
+            index = self.experience_memory.sample(batch_size - n_sampled)
+            e = self.experience_memory.get(index)
+            x, y, next_x, next_y = [e[c].astype(np.int64) for c in ['x', 'y', 'next_x', 'next_y']]
+            replayable = (self.feature_constructor.reachable_map[next_x, next_y] != 0) \
+                         & np.isin(e['t'] - e['t'] % GLOBAL_STATE_UPDATE_CYCLE, history) \
+                         & np.isin(e['next_t'] - e['next_t'] % GLOBAL_STATE_UPDATE_CYCLE, history) \
+                         & (self.feature_constructor.DT[x, y, e['ax'] + settings.MAX_MOVE, e['ay'] + settings.MAX_MOVE] <= 1)
+            self.experience_memory.invalidate(index[~replayable])
+            sampled.append(index[replayable])
+            n_sampled += replayable.sum()
+            if n_sampled == batch_size:
+                return self.experience_memory.get(np.concatenate(sampled))
         raise Exception
+
+    # Replay a batch of transitions, returns their state-action features and double DQN targets
+    def replay_memory(self, batch_size):
+        e = self.sample_experience(batch_size)
+        order, sa = [], []
+        for tm in np.unique(e['t']).tolist():
+            i = np.nonzero(e['t'] == tm)[0]
+            sd, f = self.replay_supply_demand(tm)   # Get supply demand map, and fingerprint
+            xs, ys = e['x'][i].astype(np.int64), e['y'][i].astype(np.int64)
+            ax, ay = e['ax'][i].astype(np.int64), e['ay'][i].astype(np.int64)
+            order.append(i)
+            sa.append(np.hstack([self.feature_constructor.construct_state_features(tm, f, xs, ys, sd),
+                                 self.feature_constructor.gather_action_features(xs, ys, ax, ay, sd)]))
+        sa = np.concatenate(sa)[np.argsort(np.concatenate(order))]
+
+        # State-action rows of all the next states, grouped by next state
+        order, next_sa, sizes = [], [], []
+        for next_t in np.unique(e['next_t']).tolist():
+            i = np.nonzero(e['next_t'] == next_t)[0]
+            next_sd, next_f = self.replay_supply_demand(next_t)
+            next_l = np.stack([e['next_x'][i], e['next_y'][i]], axis=1)
+            rows, n_rows, _ = self.feature_constructor.construct_features_batch(next_t, next_f, next_l, next_sd)
+            order.append(i)
+            next_sa.append(rows)
+            sizes.append(n_rows)
+        target_values = np.empty(batch_size)
+        target_values[np.concatenate(order)] = self.q_network.compute_target_values_batch(np.concatenate(next_sa),
+                                                                                          np.concatenate(sizes))
+        discount_factor = settings.GAMMA ** ((e['next_t'] - e['t']) / 60).astype(int)
+        y = e['reward'].astype(np.float64) + discount_factor * target_values
+        return sa, y
@@ -1,11 +1,12 @@
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from skimage.transform import downscale_local_mean, resize
 import os
 from common.time_utils import get_local_datetime
 from config.settings import MAP_WIDTH, MAP_HEIGHT, DATA_DIR, MIN_DISPATCH_CYCLE,\
     DESTINATION_PROFILE_SPATIAL_AGGREGATION, DESTINATION_PROFILE_TEMPORAL_AGGREGATION
 from simulator.settings import MAX_MOVE, NUM_SUPPLY_DEMAND_MAPS, FLAGS
-from common import mesh
+from common import mesh, table_cache
 from novelties import status_codes
 from dummy_agent.demand_loader import DemandLoader
 
@@ -20,26 +21,38 @@ class FeatureConstructor(object):
         self.reachable_map = self.load_reachable_map()
         self.state_space = [(x, y) for x in range(MAP_WIDTH) for y in range(MAP_HEIGHT) if self.reachable_map[x, y] == 1]
         self.DT = self.load_dt_map()
-        if FLAGS.average:
-            self.D_out = self.D_in = np.ones((MAP_WIDTH, MAP_HEIGHT)) / (L ** 2)
+        self.action_offsets = self.build_action_offsets()
+        self.reachable_actions, self.feasible_actions = self.build_action_tables()
+        if FLAGS.cache_tables:
+            key = table_cache.make_key(table_cache.file_digest(os.path.join(DATA_DIR, 'reachable_map.npy')),
+                                       table_cache.file_digest(os.path.join(DATA_DIR, 'tt_map.npy')),
+                                       MIN_DISPATCH_CYCLE, MAX_MOVE, FLAGS.n_diffusions, FLAGS.average)
+            tables = table_cache.load_or_build_many(os.path.join(DATA_DIR, 'diffusion_{}.npz'.format(key)),
+                                                    self.build_diffusion_tables)
         else:
-            self.D_out, self.D_in = self.build_diffusion_filter()
-
-        self.d_entropy = self.build_diffusion_entropy_map()
+            tables = self.build_diffusion_tables()
+        self.D_out, self.D_in, self.d_entropy = tables['D_out'], tables['D_in'], tables['d_entropy']
         self.TT = None
         self.OD = None
-
-
-    def action_space_iter(self, x, y):
-        yield (0, 0)
-        for ax in range(-MAX_MOVE, MAX_MOVE + 1):
-            for ay in range(-MAX_MOVE, MAX_MOVE + 1):
-                if ax == 0 and ay == 0:
-                    continue
-                x_ = x + ax
-                y_ = y + ay
-                if self.is_reachable(x_, y_):
-                    yield (ax, ay)
+        self.maps = None
+
+
+    # All (ax, ay) in the action space, waiting (0, 0) first
+    def build_action_offsets(self):
+        offsets = [(0, 0)] + [(ax, ay) for ax in range(-MAX_MOVE, MAX_MOVE + 1) for ay in range(-MAX_MOVE, MAX_MOVE + 1)
+                              if ax != 0 or ay != 0]
+        return np.array(offsets, dtype=np.int64)
+
+    # Per-cell masks over action_offsets: actions leading to a reachable cell, and those also within one dispatch cycle
+    def build_action_tables(self):
+        ax, ay = self.action_offsets.T
+        X = np.arange(MAP_WIDTH)[:, None, None] + ax
+        Y = np.arange(MAP_HEIGHT)[None, :, None] + ay
+        inside = (X >= 0) & (X < MAP_WIDTH) & (Y >= 0) & (Y < MAP_HEIGHT)
+        reachable = inside & (self.reachable_map[np.clip(X, 0, MAP_WIDTH - 1), np.clip(Y, 0, MAP_HEIGHT - 1)] == 1)
+        reachable[:, :, 0] = True      # Waiting is always possible
+        feasible = reachable & (self.DT[:, :, ax + MAX_MOVE, ay + MAX_MOVE] <= 1)
+        return reachable, feasible
 
     # def action_price_iter(self, x, y):
     #     lat, lon = mesh.convert_xy_to_lonlat(x,y)
@@ -59,21 +72,29 @@ class FeatureConstructor(object):
     def load_dt_map(self):
         return np.load(os.path.join(DATA_DIR, 'tt_map.npy')) / MIN_DISPATCH_CYCLE
 
+    def build_diffusion_tables(self):
+        if FLAGS.average:
+            self.D_out = self.D_in = np.ones((MAP_WIDTH, MAP_HEIGHT)) / (L ** 2)
+        else:
+            self.D_out, self.D_in = self.build_diffusion_filter()
+        return {'D_out': self.D_out, 'D_in': self.D_in, 'd_entropy': np.stack(self.build_diffusion_entropy_map())}
+
     # DQN Diffusion filters
     def build_diffusion_filter(self):
         D_out = np.exp(-(self.DT) ** 2 + 1) / (L ** 2)
         D_in = np.zeros((MAP_WIDTH, MAP_HEIGHT, L, L))
-        for x, y in self.state_space:
-            for ax, ay in self.action_space_iter(x, y):
-                axi, ayi = MAX_MOVE + ax, MAX_MOVE + ay
-                D_in[x, y, axi, ayi] = D_out[x + ax, y + ay, -axi-1, -ayi-1]
+        # Every reachable action from a cell of the state space, seen from its destination the offset is flipped
+        x, y, a = np.nonzero(self.reachable_actions & (self.reachable_map == 1)[:, :, None])
+        ax, ay = self.action_offsets[a].T
+        axi, ayi = MAX_MOVE + ax, MAX_MOVE + ay
+        D_in[x, y, axi, ayi] = D_out[x + ax, y + ay, L - 1 - axi, L - 1 - ayi]
         return D_out, D_in
 
     # Entropy for each (x, y) in map
     def build_diffusion_entropy_map(self):
-        entropy = np.zeros((MAP_WIDTH, MAP_HEIGHT))
-        for x, y in self.state_space:
-            entropy[x, y] = -(self.D_out[x, y] * np.log(self.D_out[x, y] + 1e-6)).sum()
+        entropy = -(self.D_out * np.log(self.D_out + 1e-6))
+        entropy = entropy.sum(axis=tuple(range(2, entropy.ndim)))     # The average filter is one weight per cell
+        entropy = np.where(self.reachable_map == 1, entropy, 0)
         entropy /= np.log(L ** 2 + 1e-6)
         diffused_entropy = [entropy] + self.diffusion_convolution(entropy, self.D_out, FLAGS.n_diffusions - 1)
         return diffused_entropy
@@ -89,17 +110,15 @@ class FeatureConstructor(object):
         idle_map = self.construct_supply_map(idle[["lon", "lat"]].values)
         dropoff_map = self.construct_supply_map(occupied[["destination_lon", "destination_lat"]].values)
         self.supply_maps = [idle_map, dropoff_map]
-        self.diffused_supply = []
-        for s in self.supply_maps:
-            self.diffused_supply += self.diffusion_convolution(s, self.D_in, FLAGS.n_diffusions)
+        self.maps = None
+        self.diffused_supply = self.diffusion_convolution_maps(self.supply_maps, self.D_in, FLAGS.n_diffusions)
 
     # Update demand at given time t,
     def update_demand(self, t, demand_normalized_factor=0.1, tt_normalized_factor=1.0/1800, horizon=2):
         profile, diff = self.demand_loader.load(t, horizon=horizon)     #Get demand profile, and demand difference
         self.demand_maps = [d * demand_normalized_factor for d in profile] + [diff]
-        self.diffused_demand = []
-        for d in self.demand_maps:
-            self.diffused_demand += self.diffusion_convolution(d, self.D_out, FLAGS.n_diffusions)
+        self.maps = None
+        self.diffused_demand = self.diffusion_convolution_maps(self.demand_maps, self.D_out, FLAGS.n_diffusions)
 
         if FLAGS.trip_diffusion:
             if self.OD is None or t % (DESTINATION_PROFILE_TEMPORAL_AGGREGATION * 3600) == 0:
@@ -111,12 +130,16 @@ class FeatureConstructor(object):
             self.diffused_demand.append(self.TT)
 
     def diffusion_convolution(self, img, d_filter, k):
-        M = img
+        return self.diffusion_convolution_maps([img], d_filter, k)
+
+    # Diffuses all the maps together; returns the k diffused maps of the first map, then of the second, ...
+    def diffusion_convolution_maps(self, imgs, d_filter, k):
+        M = np.stack(imgs)
         diffused_maps = []
         for _ in range(k):
-            M = self.diffuse_map(M, d_filter)
+            M = self.diffuse_maps(M, d_filter)
             diffused_maps.append(M)
-        return diffused_maps
+        return [diffused_maps[step][i] for i in range(len(imgs)) for step in range(k)]
 
     def trip_diffusion_convolution(self, img, trip_filter):
         n = DESTINATION_PROFILE_SPATIAL_AGGREGATION
@@ -126,11 +149,17 @@ class FeatureConstructor(object):
         return M
 
     def diffuse_map(self, img, d_filter):
-        padded_map = np.pad(img, MAX_MOVE, "constant")
-        diffused_map = self.construct_initial_map()
-        for x, y in self.state_space:
-            diffused_map[x, y] = (padded_map[x : x + L, y : y + L] * d_filter[x, y]).sum()
-        return diffused_map
+        return self.diffuse_maps(img[None], d_filter)[0]
+
+    # Each cell of the state space gets its L x L neighbourhood weighted by its filter, for a (n, W, H) stack of maps
+    def diffuse_maps(self, imgs, d_filter):
+        padded_maps = np.pad(imgs, ((0, 0), (MAX_MOVE, MAX_MOVE), (MAX_MOVE, MAX_MOVE)), "constant")
+        windows = sliding_window_view(padded_maps, (L, L), axis=(1, 2))     # (n, W, H, L, L)
+        if d_filter.ndim == 2:
+            diffused_maps = windows.sum(axis=(3, 4)) * d_filter
+        else:
+            diffused_maps = np.einsum('nxyij,xyij->nxy', windows, d_filter)
+        return np.where(self.reachable_map == 1, diffused_maps, 0).astype(np.float32)
 
     def update_fingerprint(self, fingerprint):
         self.fingerprint = fingerprint
@@ -143,49 +172,60 @@ class FeatureConstructor(object):
         s, actions = self.construct_features(tm, finprint, Loc, Maps)
         return s, actions
 
+    def construct_current_features_batch(self, Locs):
+        return self.construct_features_batch(self.get_current_time(), self.get_current_fingerprint(), Locs,
+                                             self.get_supply_demand_maps())
+
+    # Maps: stacked (n_maps, W, H) array from get_supply_demand_maps
     def construct_features(self, tm, finprint, Loc, Maps):
         state_feature = self.construct_state_feature(tm, finprint, Loc, Maps)
         actions, action_features = self.construct_action_features(tm, Loc, Maps)
         s = (state_feature, action_features)
         return s, actions
 
+    # State-action rows of many cells at once, grouped by cell.
+    # Returns the (n_rows, n_features) matrix, the number of rows of each cell and the actions of each cell
+    def construct_features_batch(self, tm, finprint, Locs, Maps):
+        xs, ys = np.array(Locs, dtype=np.int64).reshape(-1, 2).T
+        cells, aidx = np.nonzero(self.feasible_actions[xs, ys])
+        sizes = np.bincount(cells, minlength=len(xs))
+        state_features = self.construct_state_features(tm, finprint, xs, ys, Maps)
+        ax, ay = self.action_offsets[aidx].T
+        sa = np.hstack([state_features[cells], self.gather_action_features(xs[cells], ys[cells], ax, ay, Maps)])
+        actions = [[tuple(a) for a in part.tolist()] for part in np.split(self.action_offsets[aidx], np.cumsum(sizes)[:-1])]
+        return sa, sizes, actions
+
     def construct_state_feature(self, tm, finprint, Loc, Maps):
         x, y = Loc
-        state_feature = [m.mean() for m in Maps[:NUM_SUPPLY_DEMAND_MAPS]]
-        state_feature += [m[x, y] for m in Maps]
-        state_feature += [m[x, y] for m in self.d_entropy]
-        state_feature += self.construct_time_features(tm) + self.construct_fingerprint_features(finprint)
-        return state_feature
+        return self.construct_state_features(tm, finprint, np.array([x]), np.array([y]), Maps)[0]
 
-    def construct_action_features(self, tm, Loc, Maps):
-        actions = []
-        action_features = []
-
-        for ax, ay in self.action_space_iter(*Loc):
-            act = (ax, ay)
-            feature = self.construct_action_feature(tm, Loc, Maps, act)
-            if feature is not None:
-                actions.append(act)
-                action_features.append(feature)
+    def construct_state_features(self, tm, finprint, xs, ys, Maps):
+        n = len(xs)
+        means = Maps[:NUM_SUPPLY_DEMAND_MAPS].mean(axis=(1, 2))
+        time_fingerprint = np.array(self.construct_time_features(tm) + self.construct_fingerprint_features(finprint))
+        return np.hstack([np.broadcast_to(means, (n, len(means))), Maps[:, xs, ys].T, self.d_entropy[:, xs, ys].T,
+                          np.broadcast_to(time_fingerprint, (n, len(time_fingerprint)))]).astype(np.float32)
 
+    def construct_action_features(self, tm, Loc, Maps):
+        x, y = Loc
+        ax, ay = self.action_offsets[self.feasible_actions[x, y]].T
+        actions = list(zip(ax.tolist(), ay.tolist()))
+        action_features = self.gather_action_features(np.full(len(ax), x), np.full(len(ay), y), ax, ay, Maps)
         return actions, action_features
 
-    def is_reachable(self, x, y):
-        return 0 <= x and x < MAP_WIDTH and 0 <= y and y < MAP_HEIGHT and self.reachable_map[x, y] == 1
+    # Features of taking action (ax, ay) from (xs, ys), one row per action
+    def gather_action_features(self, xs, ys, ax, ay, Maps):
+        x_, y_ = xs + ax, ys + ay
+        tt = self.DT[xs, ys, ax + MAX_MOVE, ay + MAX_MOVE]
+        return np.hstack([Maps[:, x_, y_].T, self.d_entropy[:, x_, y_].T, tt[:, None]]).astype(np.float32)
 
     def construct_action_feature(self, tm, Loc, Maps, acts):
         x, y = Loc
         ax, ay = acts       #Action in action space
-        x_ = x + ax
-        y_ = y + ay
         tt = self.get_triptime(x, y, ax, ay)
 
         if tt <= 1:
-            action_feature = [m[x_, y_] for m in Maps]
-            action_feature += [m[x_, y_] for m in self.d_entropy]
-            action_feature += [tt]
-            # action_feature += self.construct_location_features((x_, y_)) + [tt]
-            return action_feature
+            return self.gather_action_features(np.array([x]), np.array([y]), np.array([ax]), np.array([ay]), Maps)[0]
 
         return None
 
@@ -193,10 +233,29 @@ class FeatureConstructor(object):
     def get_triptime(self, x, y, ax, ay):
         return self.DT[x, y, ax + MAX_MOVE, ay + MAX_MOVE]
 
+    # All supply and demand maps stacked into one (n_maps, W, H) array, rebuilt after each update
     def get_supply_demand_maps(self):
-        supply_demand_maps = self.supply_maps + self.demand_maps
-        diffused_maps = self.diffused_supply + self.diffused_demand
-        return supply_demand_maps + diffused_maps
+        if self.maps is None:
+            supply_demand_maps = self.supply_maps + self.demand_maps
+            diffused_maps = self.diffused_supply + self.diffused_demand
+            self.maps = np.stack(supply_demand_maps + diffused_maps).astype(np.float32)
+        return self.maps
+
+    # The supply and demand maps without their diffusions, (NUM_SUPPLY_DEMAND_MAPS, W, H)
+    def get_raw_supply_demand_maps(self):
+        return np.stack(self.supply_maps + self.demand_maps)
+
+    # Rebuilds the get_supply_demand_maps array of time t from its raw maps
+    def expand_supply_demand_maps(self, t, raw_maps, tt_normalized_factor=1.0/1800):
+        supply_maps, demand_maps = list(raw_maps[:2]), list(raw_maps[2:])     # Idle and dropoff maps first
+        diffused_supply = self.diffusion_convolution_maps(supply_maps, self.D_in, FLAGS.n_diffusions)
+        diffused_demand = self.diffusion_convolution_maps(demand_maps, self.D_out, FLAGS.n_diffusions)
+        if FLAGS.trip_diffusion:
+            OD, TT = self.demand_loader.load_OD_matrix(t)
+            d = sum(diffused_demand[:len(demand_maps) - 1])
+            diffused_demand.append(self.trip_diffusion_convolution(d, OD))
+            diffused_demand.append(resize(TT * tt_normalized_factor, (MAP_WIDTH, MAP_HEIGHT), mode='edge'))
+        return np.stack(supply_maps + demand_maps + diffused_supply + diffused_demand).astype(np.float32)
 
     def construct_initial_map(self, w=MAP_WIDTH, h=MAP_HEIGHT):
         return np.zeros((w, h), dtype=np.float32)
@@ -0,0 +1,119 @@
+import os
+import glob
+import numpy as np
+from dqn_agent.replay_memory import ReplayMemory
+
+
+def sd_dtype(n_maps, shape):
+    return np.dtype([('t', np.int64), ('fingerprint', np.float64, (2,)), ('maps', np.float16, (n_maps,) + tuple(shape))])
+
+
+# Writes experience to numbered shards in directory while it is collected: sars_<i>.npy holds transitions as a record
+# array with the ReplayMemory columns, and sd_<i>.npy the supply demand snapshots they refer to. A shard is written
+# with the snapshot that follows shard_size transitions (or max_snapshots snapshots), so each shard only refers to
+# snapshots of earlier shards.
+# Shards are numbered after the ones already in directory, and manifest.txt lists the shards of the current run only,
+# so loading the directory never mixes in the experience of earlier runs. The shards of runs before the previous one are
+# removed when the first shard is written; the previous run's are kept as they may still be loaded from this directory.
+class MemoryShardWriter(object):
+    def __init__(self, directory, n_maps, shape, shard_size=100000, max_snapshots=288):
+        self.directory = directory
+        self.sars_dtype = np.dtype(ReplayMemory.COLUMNS)
+        self.sd_dtype = sd_dtype(n_maps, shape)
+        self.shard_size = shard_size
+        self.max_snapshots = max_snapshots
+        indices = shard_indices(directory)
+        self.n_shards = max(indices) + 1 if indices else 0
+        manifest = read_manifest(directory)
+        self.kept_shards = set(indices if manifest is None else manifest)
+        self.shards = []
+        self.rows = []
+        self.experience = []
+        self.n_experience = 0
+        self.snapshots = []
+
+    # Same arguments as ReplayMemory.append
+    def append(self, *row):
+        self.rows.append(row)
+        self.n_experience += 1
+
+    def pack_rows(self):
+        if self.rows:
+            self.experience.append(np.array(self.rows, dtype=self.sars_dtype))
+            self.rows = []
+
+    def extend(self, **columns):
+        self.pack_rows()
+        rows = np.empty(len(columns['t']), dtype=self.sars_dtype)
+        for name in self.sars_dtype.names:
+            rows[name] = columns[name]
+        self.experience.append(rows)
+        self.n_experience += len(rows)
+
+    def add_snapshot(self, t, raw_maps, fingerprint):
+        self.snapshots.append(np.array([(t, fingerprint, raw_maps)], dtype=self.sd_dtype))
+        if self.n_experience >= self.shard_size or len(self.snapshots) >= self.max_snapshots:
+            self.flush()
+
+    def flush(self):
+        if self.n_experience == 0 and len(self.snapshots) == 0:
+            return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        if not self.shards:
+            self.remove_stale_shards()
+        self.pack_rows()
+        sars = np.concatenate(self.experience) if self.experience else np.empty(0, dtype=self.sars_dtype)
+        sd = np.concatenate(self.snapshots) if self.snapshots else np.empty(0, dtype=self.sd_dtype)
+        np.save(os.path.join(self.directory, "sd_{:05d}.npy".format(self.n_shards)), sd)
+        np.save(os.path.join(self.directory, "sars_{:05d}.npy".format(self.n_shards)), sars)
+        self.shards.append(self.n_shards)
+        self.n_shards += 1
+        write_manifest(self.directory, self.shards)
+        self.experience, self.n_experience, self.snapshots = [], 0, []
+
+
+    def remove_stale_shards(self):
+        for i in shard_indices(self.directory):
+            if i not in self.kept_shards:
+                for prefix in ["sd", "sars"]:
+                    path = os.path.join(self.directory, "{}_{:05d}.npy".format(prefix, i))
+                    if os.path.exists(path):
+                        os.remove(path)
+
+
+def shard_indices(directory):
+    sars_paths = glob.glob(os.path.join(directory, "sars_*.npy"))
+    return sorted(int(os.path.basename(p)[len("sars_"):-len(".npy")]) for p in sars_paths)
+
+
+# Shard indices written by the last run, None for directories without a manifest
+def read_manifest(directory):
+    path = os.path.join(directory, "manifest.txt")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return [int(line) for line in f.read().split()]
+
+
+def write_manifest(directory, indices):
+    path = os.path.join(directory, "manifest.txt")
+    with open(path + ".tmp", "w") as f:
+        f.write("".join("{}\n".format(i) for i in indices))
+    os.replace(path + ".tmp", path)
+
+
+# (sd, sars) paths of the shards of the last run, or of all the shards if the directory has no manifest
+def list_shards(directory):
+    indices = read_manifest(directory)
+    if indices is None:
+        indices = shard_indices(directory)
+    return [(os.path.join(directory, "sd_{:05d}.npy".format(i)), os.path.join(directory, "sars_{:05d}.npy".format(i)))
+            for i in indices]
+
+
+# Memory-mapped (snapshots, transitions) of each shard in order, read lazily. The shards are listed right away,
+# before this run writes any.
+def iter_shards(directory):
+    shards = list_shards(directory)
+    return ((np.load(sd_path, mmap_mode='r'), np.load(sars_path, mmap_mode='r')) for sd_path, sars_path in shards)
@@ -6,11 +6,18 @@ from tensorflow.keras.layers import Input, Dense
 from simulator import settings
 from simulator.settings import FLAGS
 
+# One row per action: the state feature followed by the action feature
+def state_action_matrix(s):
+    s_feature, a_features = s
+    return np.hstack([np.broadcast_to(s_feature, (len(a_features), len(s_feature))), a_features]).astype(np.float32)
+
+
 # Standrad Implementation of DeepQNetworks "Parent Class"
 class DeepQNetwork(object):
     # tf.compat.v1.disable_eager_execution()
     def __init__(self, network_path=None):
         self.sa_input, self.q_values, self.model = self.build_q_network()
+        self.weight_placeholders, self.assign_weights = None, None
         # print(FLAGS.save_network_dir)
         if not os.path.exists(FLAGS.save_network_dir):
             os.makedirs(FLAGS.save_network_dir)
@@ -41,14 +48,28 @@ class DeepQNetwork(object):
         print('Successfully loaded: ' + network_path)
 
 
+    def get_weights(self):
+        return self.sess.run(self.model.trainable_weights)
+
+    def set_weights(self, weights):
+        if self.assign_weights is None:
+            self.weight_placeholders = [tf.compat.v1.placeholder(w.dtype.base_dtype, shape=w.shape)
+                                        for w in self.model.trainable_weights]
+            self.assign_weights = [w.assign(p) for w, p in zip(self.model.trainable_weights, self.weight_placeholders)]
+        self.sess.run(self.assign_weights, feed_dict=dict(zip(self.weight_placeholders, weights)))
+
     def compute_q_values(self, s):
-        s_feature, a_features = s
         q = self.q_values.eval(
             feed_dict={
-                self.sa_input: np.array([s_feature + a_feature for a_feature in a_features], dtype=np.float32)
+                self.sa_input: state_action_matrix(s)
             })[:, 0]
         return q
 
+    # Q values of the state-action rows of many states in one forward pass, returns one array per state
+    def compute_q_values_batch(self, sa, sizes):
+        q = self.q_values.eval(feed_dict={self.sa_input: sa})[:, 0]
+        return np.split(q, np.cumsum(sizes)[:-1])
+
     # Get action associated with max q-value
     def get_action(self, q_values, amax):
         if FLAGS.alpha > 0:
@@ -114,10 +135,9 @@ class FittingDeepQNetwork(DeepQNetwork):
 
     # Calc target Q value based on State features and action features of next t
     def compute_target_q_values(self, s):
-        s_feature, a_features = s
         q = self.target_q_values.eval(
             feed_dict={
-                self.target_sub_input: np.array([s_feature + a_feature for a_feature in a_features], dtype=np.float32)
+                self.target_sub_input: state_action_matrix(s)
             })[:, 0]
         return q
 
@@ -129,6 +149,23 @@ class FittingDeepQNetwork(DeepQNetwork):
             V += FLAGS.alpha * np.log(np.exp((Q - Q.max()) / FLAGS.alpha).sum())
         return V
 
+    # compute_target_value of many next states, given their state-action rows and the number of rows of each.
+    # Runs one pass of the online network and one of the target network
+    def compute_target_values_batch(self, sa, sizes):
+        Q, target_Q = self.sess.run([self.q_values, self.target_q_values],
+                                    feed_dict={self.sa_input: sa, self.target_sub_input: sa})
+        Q, target_Q = Q[:, 0], target_Q[:, 0]
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        segments = np.repeat(np.arange(len(sizes)), sizes)
+        # First row holding the max online Q value of each state
+        is_max = np.nonzero(Q == np.maximum.reduceat(Q, starts)[segments])[0]
+        _, first = np.unique(segments[is_max], return_index=True)
+        V = target_Q[is_max[first]].astype(np.float64)
+        if FLAGS.alpha > 0:
+            target_max = np.maximum.reduceat(target_Q, starts)
+            V += FLAGS.alpha * np.log(np.add.reduceat(np.exp((target_Q - target_max[segments]) / FLAGS.alpha), starts))
+        return V
+
     # Fitting the model using state action list and associated next state
     def fit(self, sa_batch, y_batch):
         loss, _ = self.sess.run([self.loss, self.grad_update], feed_dict={
@@ -187,3 +224,25 @@ class FittingDeepQNetwork(DeepQNetwork):
         summary_str = self.sess.run(self.summary_op)
         # Write optimized avg loss, and avg q_max
         self.summary_writer.add_summary(summary_str, self.n_steps)
+
+
+# Inference-only network of the actors: epsilon-greedy actions with the weights and fingerprint sent by the learner.
+# No target network, optimizer, saver or summary writer, the learner owns those
+class ActorDeepQNetwork(DeepQNetwork):
+
+    def __init__(self):
+        self.sa_input, self.q_values, self.model = self.build_q_network()
+        self.weight_placeholders, self.assign_weights = None, None
+        self.sess = tf.compat.v1.InteractiveSession()
+        self.sess.run(tf.compat.v1.global_variables_initializer())
+        self.n_steps = 0
+        self.epsilon = settings.INITIAL_EPSILON
+
+    def get_action(self, q_values, amax):
+        if self.epsilon > np.random.random():
+            return np.random.randint(len(q_values))
+        else:
+            return super().get_action(q_values, amax)
+
+    def get_fingerprint(self):
+        return self.n_steps, self.epsilon
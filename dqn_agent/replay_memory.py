@@ -0,0 +1,82 @@
+import numpy as np
+
+
+# Circular buffer of (t, x, y, ax, ay) -> (next_t, next_x, next_y) transitions with their rewards,
+# stored as preallocated typed columns. Once full, the oldest transition is overwritten.
+class ReplayMemory(object):
+    COLUMNS = [('t', np.int64), ('x', np.int16), ('y', np.int16), ('ax', np.int8), ('ay', np.int8),
+               ('next_t', np.int64), ('next_x', np.int16), ('next_y', np.int16), ('reward', np.float32)]
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.COLUMNS}
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.head = 0       # Next slot to write
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.columns.values()) + self.valid.nbytes
+
+    def append(self, t, x, y, ax, ay, next_t, next_x, next_y, reward):
+        i = self.head
+        for name, value in zip(self.columns, (t, x, y, ax, ay, next_t, next_x, next_y, reward)):
+            self.columns[name][i] = value
+        self.valid[i] = True
+        self.head = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    # Appends many transitions given as column arrays, in order
+    def extend(self, **columns):
+        n = len(columns['t'])
+        if n > self.capacity:
+            columns = {name: values[-self.capacity:] for name, values in columns.items()}
+            n = self.capacity
+        index = (self.head + np.arange(n)) % self.capacity
+        for name in self.columns:
+            self.columns[name][index] = columns[name]
+        self.valid[index] = True
+        self.head = (self.head + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def clear(self):
+        self.valid[:] = False
+        self.head = 0
+        self.size = 0
+
+    # Marks transitions that can't be replayed, they are skipped by sample and overwritten in turn
+    def invalidate(self, index):
+        self.valid[index] = False
+
+    # Indices of n valid transitions drawn uniformly with replacement
+    def sample(self, n, max_retry=100):
+        index = np.empty(0, dtype=np.int64)
+        for _ in range(max_retry):
+            draw = np.random.randint(0, self.size, size=2 * (n - len(index)))
+            index = np.concatenate([index, draw[self.valid[draw]]])
+            if len(index) >= n:
+                return index[:n]
+        raise Exception("no valid transitions to sample")
+
+    def get(self, index):
+        return {name: column[index] for name, column in self.columns.items()}
+
+    # Chronological order, oldest first
+    def ordered_index(self):
+        if self.size < self.capacity:
+            return np.arange(self.size)
+        return (self.head + np.arange(self.capacity)) % self.capacity
+
+    # From the list of ((t, (x, y), (ax, ay)), (next_t, (next_x, next_y)), reward) tuples of older dumps
+    @classmethod
+    def from_experience(cls, experience, capacity):
+        memory = cls(capacity)
+        if experience:
+            rows = [(t, x, y, ax, ay, next_t, next_x, next_y, reward)
+                    for (t, (x, y), (ax, ay)), (next_t, (next_x, next_y)), reward in experience]
+            values = zip(*rows)
+            memory.extend(**{name: np.array(v, dtype=dtype) for (name, dtype), v in zip(cls.COLUMNS, values)})
+        return memory
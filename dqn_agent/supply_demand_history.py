@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import numpy as np
+
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+
+# Supply demand snapshots of the last `capacity` global state updates, kept in a preallocated float16 ring.
+# Only the raw supply and demand maps are stored; expand(t, raw_maps) recomputes the full stack of maps with their
+# diffusions, and the cache_size most recently used stacks are cached.
+# float16 keeps 11 significant bits: counts up to 2048 are exact, other values are rounded to a relative error of
+# at most 2^-11, and values beyond the float16 range are clipped to it.
+class SupplyDemandHistory(object):
+    def __init__(self, capacity, n_maps, shape, expand, cache_size):
+        self.capacity = capacity
+        self.maps = np.zeros((capacity, n_maps) + tuple(shape), dtype=np.float16)
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.fingerprints = np.zeros((capacity, 2), dtype=np.float64)
+        self.slots = OrderedDict()     # Time to slot, oldest first
+        self.expand = expand
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, t):
+        return t in self.slots
+
+    def keys(self):
+        return self.slots.keys()
+
+    @property
+    def nbytes(self):
+        return self.maps.nbytes + self.times.nbytes + self.fingerprints.nbytes
+
+    def add(self, t, raw_maps, fingerprint):
+        if t in self.slots:
+            slot = self.slots[t]
+        elif len(self.slots) < self.capacity:
+            slot = len(self.slots)
+        else:
+            _, slot = self.slots.popitem(last=False)     # Overwrite the oldest snapshot
+            self.cache.pop(self.times[slot], None)
+        self.slots[t] = slot
+        self.maps[slot] = np.clip(raw_maps, -FLOAT16_MAX, FLOAT16_MAX)
+        self.times[slot] = t
+        self.fingerprints[slot] = fingerprint
+        self.cache.pop(t, None)
+
+    # Full maps and fingerprint at t, or None
+    def get(self, t):
+        slot = self.slots.get(t)
+        if slot is None:
+            return None
+        if t in self.cache:
+            self.cache.move_to_end(t)
+            maps = self.cache[t]
+        else:
+            maps = self.expand(t, self.maps[slot].astype(np.float32))
+            self.cache[t] = maps
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        n_steps, epsilon = self.fingerprints[slot]
+        return maps, (int(n_steps), epsilon)
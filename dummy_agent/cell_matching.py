@@ -0,0 +1,271 @@
+"""Ride-share matching of the requests of one cell to its candidate vehicles, on dense blocks of the round's ETA
+matrices. Does not depend on the simulator so that cells can be solved in worker processes."""
+import numpy as np
+from collections import defaultdict
+from multiprocessing import shared_memory
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from common.geoutils import great_circle_distance
+
+
+def min_cost_assignment(T, max_cost, n_nearest=None):
+    """(row, column) pairs of the assignment of the rows of the cost matrix T to its columns that assigns the most
+    rows at a cost of at most max_cost, then has the lowest total cost. Rows that cannot be assigned within
+    max_cost are left out.
+
+    Solved with the Hungarian method on the dense matrix, or, given n_nearest, as a sparse min-cost matching
+    over the n_nearest cheapest columns of each row. Both give the same assignment when n_nearest covers all
+    the columns and the optimum is unique.
+    """
+    n_rows, n_cols = T.shape
+    if n_rows == 0 or n_cols == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    T = T.astype(np.float64)
+    feasible = T <= max_cost
+
+    if n_nearest is None:
+        # Leaving a row out costs more than assigning all the others
+        penalty = max_cost * (min(n_rows, n_cols) + 1)
+        rows, cols = linear_sum_assignment(np.where(feasible, T, penalty))
+    else:
+        k = min(n_nearest, n_cols)
+        rows = np.repeat(np.arange(n_rows), k)
+        cols = np.argpartition(T, k - 1, axis=1)[:, :k].ravel()
+        keep = feasible[rows, cols]
+        rows, cols = rows[keep], cols[keep]
+        # One dummy column per row so that every row can be matched; costs are shifted by 1
+        # because the solver treats zeros as missing edges
+        penalty = (max_cost + 1) * (n_rows + 1)
+        dummies = np.arange(n_rows)
+        graph = csr_matrix((np.concatenate([T[rows, cols] + 1, np.full(n_rows, penalty)]),
+                            (np.concatenate([rows, dummies]), np.concatenate([cols, n_cols + dummies]))),
+                           shape=(n_rows, n_cols + n_rows))
+        rows, cols = min_weight_full_bipartite_matching(graph)
+        real = cols < n_cols
+        rows, cols = rows[real], cols[real]
+
+    keep = feasible[rows, cols]
+    return rows[keep], cols[keep]
+
+
+class GreedyCellSolver(object):
+    """Takes the requests of the cell in order and gives each the vehicle with the lowest ETA, pooling it with the
+    requests the vehicle already got as long as their destinations stay within reject_wait_time of each other."""
+    def __init__(self, reject_wait_time):
+        self.reject_wait_time = reject_wait_time
+
+    # T, dist: (requests, vehicles) ETAs and distances, updated in place; TRR, d_RR, TDD: (requests, requests)
+    # ETAs, distances and destination ETAs; full: whether each vehicle has reached its capacity.
+    # Returns the (vehicle, request, ETA, distance) assignments by position, in the order they are made
+    def assign(self, T, TRR, TDD, dist, d_RR, full):
+        return self.pool_requests(range(T.shape[0]), defaultdict(list), T, TRR, TDD, dist, d_RR, full)
+
+    def pool_requests(self, rows, pooled, T, TRR, TDD, dist, d_RR, full):
+        assignments = []
+        for ri in rows:
+            # For this request ri, pick the min from all candidate vehicles
+            vi = T[ri].argmin()
+            tt = T[ri, vi]
+            dd = dist[ri, dist[ri].argmin()]
+            if tt > self.reject_wait_time:
+                continue
+
+            if not full[vi]:
+                if len(pooled[vi]) > 0:
+                    shared = pooled[vi] + [ri]
+                    if TDD[shared][:, shared].max() > self.reject_wait_time:
+                        continue
+                pooled[vi].append(ri)
+                assignments.append((vi, ri, tt, dd))
+                T[:, vi] = T[:, vi] + TRR[:, ri]
+                dist[:, vi] = d_RR[:, ri]
+            else:
+                T[:, vi] = float('inf')
+                dist[:, vi] = float('inf')
+        return assignments
+
+
+class OptimalCellSolver(GreedyCellSolver):
+    """Assigns one request per vehicle optimally with min_cost_assignment, then pools the remaining requests
+    greedily."""
+    def __init__(self, reject_wait_time, n_nearest, dense_limit):
+        super().__init__(reject_wait_time)
+        self.n_nearest = n_nearest          # candidate vehicles per request in the sparse solver
+        self.dense_limit = dense_limit      # max number of (request, vehicle) pairs solved densely
+
+    # Returns the (request index, vehicle index) pairs of the assignment, T is (requests, vehicles)
+    def solve_assignment(self, T):
+        n_nearest = None if T.size <= self.dense_limit else self.n_nearest
+        return min_cost_assignment(T, self.reject_wait_time, n_nearest)
+
+    def assign(self, T, TRR, TDD, dist, d_RR, full):
+        free = np.nonzero(~np.asarray(full, dtype=bool))[0]
+        pooled = defaultdict(list)
+        assignments = []
+        assigned = set()
+        for ri, vi in zip(*self.solve_assignment(T[:, free])):
+            vi = free[vi]
+            pooled[vi].append(ri)
+            assignments.append((vi, ri, T[ri, vi], dist[ri, vi]))
+            assigned.add(ri)
+            T[:, vi] = T[:, vi] + TRR[:, ri]
+            dist[:, vi] = d_RR[:, ri]
+
+        remaining = [ri for ri in range(T.shape[0]) if ri not in assigned]
+        return assignments + self.pool_requests(remaining, pooled, T, TRR, TDD, dist, d_RR, full)
+
+
+ETA_MATRICES = ['T', 'TRR', 'TDD']
+
+
+# Arrays of one matching round: the CSR components of the sparse (vehicles, requests) ETAs T, the (requests, requests)
+# ETAs TRR and destination ETAs TDD, and the (lat, lon) of the vehicles and requests. The sparse matrices hold
+# explicit zeros, a pair is held whether or not its ETA is zero
+def round_arrays(T, TRR, TDD, v_latlon, r_latlon):
+    arrays = {'v_latlon': np.ascontiguousarray(v_latlon, dtype=np.float64),
+              'r_latlon': np.ascontiguousarray(r_latlon, dtype=np.float64)}
+    for name, eta in zip(ETA_MATRICES, [T, TRR, TDD]):
+        arrays[name + '_data'], arrays[name + '_indices'], arrays[name + '_indptr'] = eta.data, eta.indices, eta.indptr
+        arrays[name + '_shape'] = np.array(eta.shape, dtype=np.int64)
+    return arrays
+
+
+# What cell_blocks reads, built from round_arrays: each ETA matrix with the matrix of the pairs it holds
+def round_context(arrays):
+    context = {'v_latlon': arrays['v_latlon'], 'r_latlon': arrays['r_latlon']}
+    for name in ETA_MATRICES:
+        indices, indptr = arrays[name + '_indices'], arrays[name + '_indptr']
+        shape = tuple(arrays[name + '_shape'].tolist())
+        context[name] = (csr_matrix((arrays[name + '_data'], indices, indptr), shape=shape),
+                         csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=shape))
+    return context
+
+
+# Dense (rows, cols) block of an ETA matrix of the context, inf for the pairs it does not hold
+def eta_block(eta, rows, cols):
+    T, has_pair = eta
+    block = T[rows][:, cols].toarray()
+    block[~has_pair[rows][:, cols].toarray()] = float('inf')
+    return block
+
+
+# ETA and distance blocks of one cell for its requests ridx and candidate vehicles vidx: (requests, vehicles)
+# ETAs and distances, then (requests, requests) ETAs, distances and destination ETAs. previous holds the requests
+# each vehicle got in earlier cells, which delay its ETAs, and blocked the vehicles taken out in earlier cells
+def cell_blocks(context, ridx, vidx, previous, blocked):
+    ridx, vidx = np.array(ridx), np.array(vidx)
+    v_latlon, r_latlon = context['v_latlon'], context['r_latlon']
+    r_lat, r_lon = r_latlon[ridx, 0], r_latlon[ridx, 1]
+    cell_T = eta_block(context['T'], vidx, ridx).T
+    cell_dist = great_circle_distance(v_latlon[vidx, 0][:, None], v_latlon[vidx, 1][:, None],
+                                      r_lat, r_lon).astype(np.float32).T
+    for j in range(len(vidx)):
+        if blocked[j]:
+            cell_T[:, j] = float('inf')
+            cell_dist[:, j] = float('inf')
+        elif previous[j]:
+            previous_TRR = eta_block(context['TRR'], ridx, previous[j])
+            for c in range(len(previous[j])):
+                cell_T[:, j] = cell_T[:, j] + previous_TRR[:, c]
+            last = previous[j][-1:]
+            cell_dist[:, j] = great_circle_distance(r_lat[:, None], r_lon[:, None], r_latlon[last, 0],
+                                                    r_latlon[last, 1]).astype(np.float32)[:, 0]
+    cell_d_RR = great_circle_distance(r_lat[:, None], r_lon[:, None], r_lat, r_lon).astype(np.float32)
+    return cell_T, cell_dist, eta_block(context['TRR'], ridx, ridx), cell_d_RR, eta_block(context['TDD'], ridx, ridx)
+
+
+# Groups cells into waves of cells that share no candidate vehicle.
+# A cell goes one wave after the last earlier cell it shares a vehicle with, so solving the waves in order
+# gives the same result as solving the cells one by one
+def partition_cells(cells_vidx, n_vehicles):
+    last_wave = np.full(n_vehicles, -1, dtype=np.int64)
+    waves = []
+    for i, vidx in enumerate(cells_vidx):
+        wave = int(last_wave[vidx].max()) + 1
+        last_wave[vidx] = wave
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append(i)
+    return waves
+
+
+# Solves the cells of a round, given in order as (ridx, vidx, full) with the request indices, candidate vehicle
+# indices and whether each vehicle is full. Cells of a wave share no vehicle, so with an executor the cells of a
+# wave are solved in its worker processes, on the round's arrays shared once. The result is the same as solving the
+# cells one by one: the (vehicle, request, ETA, distance) assignments of each cell, by position in the cell
+def match_cells(solver, arrays, cells, executor=None, n_workers=1):
+    context = round_context(arrays)
+    assigned = defaultdict(list)    # Requests assigned to each vehicle index in earlier cells
+    blocked = set()                 # Vehicle indices taken out in earlier cells
+    cell_assignments = [None] * len(cells)
+    shared = None
+    try:
+        for wave in partition_cells([vidx for _, vidx, _ in cells], len(arrays['v_latlon'])):
+            wave_cells = [(ridx, vidx, [assigned[vi] for vi in vidx], [vi in blocked for vi in vidx], full)
+                          for ridx, vidx, full in (cells[i] for i in wave)]
+            if executor is not None and len(wave) > 1:
+                if shared is None:
+                    shared = share_arrays(arrays)
+                n = len(wave_cells)
+                results = executor.map(solve_shared_cell, [solver] * n, [shared[1]] * n, wave_cells,
+                                       chunksize=int(np.ceil(n / n_workers)))
+            else:
+                results = [solve_cell(solver, context, cell) for cell in wave_cells]
+            for i, (assignments, cleared) in zip(wave, results):
+                ridx, vidx, _ = cells[i]
+                for vi in cleared:
+                    blocked.add(vidx[vi])
+                for vi, ri, _, _ in assignments:
+                    assigned[vidx[vi]].append(ridx[ri])
+                cell_assignments[i] = assignments
+    finally:
+        if shared is not None:
+            shared[0].close()
+            shared[0].unlink()
+    return cell_assignments
+
+
+# Solves one cell, given as (ridx, vidx, previous, blocked, full) where full tells whether each vehicle has reached
+# its capacity. Returns the cell's assignments and the vehicles whose columns the solver cleared, which stay out of
+# the later cells
+def solve_cell(solver, context, cell):
+    ridx, vidx, previous, blocked, full = cell
+    T, dist, TRR, d_RR, TDD = cell_blocks(context, ridx, vidx, previous, blocked)
+    assignments = solver.assign(T, TRR, TDD, dist, d_RR, full)
+    return assignments, np.nonzero(np.isinf(dist).all(axis=0))[0]
+
+
+# Copies round_arrays into one shared memory block, returns the block and the spec workers attach with
+def share_arrays(arrays):
+    layout, size = [], 0
+    for name, array in arrays.items():
+        layout.append((name, array.dtype.str, array.shape, size))
+        size += -(-array.nbytes // 8) * 8      # Keeps the arrays 8-byte aligned
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for (name, dtype, shape, offset) in layout:
+        np.ndarray(shape, dtype, buffer=block.buf, offset=offset)[...] = arrays[name]
+    return block, (block.name, layout)
+
+
+attached = None     # (block name, shared memory, context) of the round a worker process mapped last
+
+
+def shared_context(spec):
+    global attached
+    name, layout = spec
+    if attached is None or attached[0] != name:
+        if attached is not None:
+            block = attached[1]
+            attached = None         # Drops the views into the previous round's block before closing it
+            block.close()
+        block = shared_memory.SharedMemory(name=name)
+        arrays = {key: np.ndarray(shape, dtype, buffer=block.buf, offset=offset)
+                  for key, dtype, shape, offset in layout}
+        attached = (name, block, round_context(arrays))
+    return attached[2]
+
+
+# solve_cell in a worker process, on the round's arrays shared by share_arrays
+def solve_shared_cell(solver, spec, cell):
+    return solve_cell(solver, shared_context(spec), cell)
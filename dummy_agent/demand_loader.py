@@ -1,17 +1,27 @@
+import os
 import numpy as np
 import pandas as pd
 from db import engine
+from common import table_cache
+from common.prefetcher import Prefetcher
 from common.time_utils import get_local_datetime
-from config.settings import MAP_WIDTH, MAP_HEIGHT, GLOBAL_STATE_UPDATE_CYCLE,\
+from simulator.settings import FLAGS
+from config.settings import DATA_DIR, DB_HOST_PATH, MAP_WIDTH, MAP_HEIGHT, GLOBAL_STATE_UPDATE_CYCLE,\
     DESTINATION_PROFILE_TEMPORAL_AGGREGATION, DESTINATION_PROFILE_SPATIAL_AGGREGATION
 
 
 class DemandLoader(object):
+    demand_profiles = None
+    od_profiles = {}
+    latest_demand_store = None
+    latest_demand_loaded = False
+
     def __init__(self, timestep=1800, amplification_factor=1.0):
         self.timestep = timestep
         self.amplification_factor = amplification_factor
         self.current_time = None
         self.hourly_demand = []
+        self.latest_demand_prefetcher = None
 
     # Loading demand within time t
     def load(self, t, horizon=2):
@@ -32,10 +42,26 @@ class DemandLoader(object):
             demand.append(d)
 
         # Loading demand of the latest timestep
-        latest_demand = self.load_latest_demand(t - self.timestep, t)
+        latest_demand = self.get_latest_demand(t - self.timestep, t)
         # Return demand in all timesteps 1 to current and the difference in demand between (At start t0 and now)
         return demand[1:], demand[0] - latest_demand
 
+    def get_latest_demand(self, t_start, t_end):
+        if self.latest_demand_prefetcher is not None:
+            return self.latest_demand_prefetcher.get((t_start, t_end))
+        return self.load_latest_demand(t_start, t_end)
+
+    # Read the latest demand maps for each update cycle until end_time on a background thread
+    def start_prefetch(self, start_time, end_time, cycle, depth):
+        start_time += -start_time % cycle
+        windows = [(t - self.timestep, t) for t in range(start_time, end_time, cycle)]
+        self.latest_demand_prefetcher = Prefetcher(lambda window: self.load_latest_demand(*window), windows, depth)
+
+    def stop_prefetch(self):
+        if self.latest_demand_prefetcher is not None:
+            self.latest_demand_prefetcher.stop()
+            self.latest_demand_prefetcher = None
+
     def __compute_demand(self, x, d):
         return ((d[1] - d[0]) * x + (d[0] + d[1]) / 2) / 3600.0 * self.timestep * self.amplification_factor
 
@@ -50,51 +76,105 @@ class DemandLoader(object):
         x = (localtime.minute - 30) / 60.0
         return x        # Fraction of hours
 
-    @staticmethod
-    def load_demand_profile(t):
+    @classmethod
+    def load_demand_profile(cls, t):
         localtime = get_local_datetime(t)
-        dayofweek, hour = localtime.weekday(), localtime.hour
-        query = """
-          SELECT x, y, demand
-          FROM demand_profile
-          WHERE dayofweek = {dayofweek} and hour = {hour};
-                """.format(dayofweek=dayofweek, hour=hour)
-        demand = pd.read_sql(query, engine, index_col=["x", "y"]).demand
-        M = np.zeros((MAP_WIDTH, MAP_HEIGHT))
-        for (x, y), c in demand.iteritems():
-            M[x, y] += c
-        return M
+        return cls.get_demand_profiles()[localtime.weekday(), localtime.hour].copy()
+
+    # Demand profiles of all (dayofweek, hour) pairs, read from the DB once per process
+    @classmethod
+    def get_demand_profiles(cls):
+        if cls.demand_profiles is None:
+            if FLAGS.cache_tables:
+                key = table_cache.make_key(DB_HOST_PATH, cls.table_version('demand_profile', 'demand'),
+                                           MAP_WIDTH, MAP_HEIGHT)
+                cls.demand_profiles = table_cache.load_or_build(
+                    os.path.join(DATA_DIR, 'demand_profile_{}.npy'.format(key)), cls.build_demand_profiles)
+            else:
+                cls.demand_profiles = cls.build_demand_profiles()
+        return cls.demand_profiles
+
+    # Changes whenever create_profile.py rewrites the table, for the keys of the cached profiles
+    @staticmethod
+    def table_version(table, *columns):
+        sums = "".join(", SUM({})".format(c) for c in columns)
+        query = "SELECT COUNT(*), MAX(rowid){} FROM {};".format(sums, table)
+        return tuple(pd.read_sql(query, engine).iloc[0].tolist())
 
     @staticmethod
-    def load_OD_matrix(t, alpha=0.1):
+    def build_demand_profiles():
+        query = """
+          SELECT dayofweek, hour, x, y, demand
+          FROM demand_profile;
+                """
+        df = pd.read_sql(query, engine)
+        P = np.zeros((7, 24, MAP_WIDTH, MAP_HEIGHT))
+        np.add.at(P, (df.dayofweek.values, df.hour.values, df.x.values, df.y.values), df.demand.values)
+        return P
+
+    @classmethod
+    def load_OD_matrix(cls, t, alpha=0.1):
         localtime = get_local_datetime(t)
         dayofweek, hour = localtime.weekday(), localtime.hour
         hours_bin = int(hour / DESTINATION_PROFILE_TEMPORAL_AGGREGATION)
+        od_profiles = cls.get_od_profiles(alpha)
+        return od_profiles['OD'][dayofweek, hours_bin], od_profiles['TT'][dayofweek, hours_bin]
+
+    # OD matrices and average trip times of all (dayofweek, hours_bin) pairs, read from the DB once per process
+    @classmethod
+    def get_od_profiles(cls, alpha):
+        if alpha not in cls.od_profiles:
+            if FLAGS.cache_tables:
+                key = table_cache.make_key(DB_HOST_PATH, cls.table_version('od_profile', 'demand', 'trip_time'),
+                                           MAP_WIDTH, MAP_HEIGHT, DESTINATION_PROFILE_TEMPORAL_AGGREGATION,
+                                           DESTINATION_PROFILE_SPATIAL_AGGREGATION, alpha)
+                cls.od_profiles[alpha] = table_cache.load_or_build_many(
+                    os.path.join(DATA_DIR, 'od_profile_{}.npz'.format(key)), lambda: cls.build_od_profiles(alpha))
+            else:
+                cls.od_profiles[alpha] = cls.build_od_profiles(alpha)
+        return cls.od_profiles[alpha]
+
+    @staticmethod
+    def build_od_profiles(alpha):
         query = """
-          SELECT origin_x, origin_y, destination_x, destination_y, demand, trip_time
-          FROM od_profile
-          WHERE dayofweek = {dayofweek} and hours_bin = {hours_bin};
-                """.format(dayofweek=dayofweek, hours_bin=hours_bin)
-        df = pd.read_sql(query, engine, index_col=["origin_x", "origin_y", "destination_x", "destination_y"])
+          SELECT dayofweek, hours_bin, origin_x, origin_y, destination_x, destination_y, demand, trip_time
+          FROM od_profile;
+                """
+        df = pd.read_sql(query, engine)
         X_size = int(MAP_WIDTH / DESTINATION_PROFILE_SPATIAL_AGGREGATION) + 1
         Y_size = int(MAP_HEIGHT / DESTINATION_PROFILE_SPATIAL_AGGREGATION) + 1
-        OD = np.full((X_size, Y_size, X_size, Y_size), alpha)
-        TT = np.zeros((X_size, Y_size, X_size, Y_size))
-        for od, row in df.iterrows():
-            OD[od] += row.demand
-            TT[od] = row.trip_time
-        for ox in range(X_size):
-            for oy in range(Y_size):
-                OD[ox, oy] /= OD[ox, oy].sum()
-        average_TT = np.zeros((X_size, Y_size))
-        for ox in range(X_size):
-            for oy in range(Y_size):
-               average_TT[ox, oy] = (TT[ox, oy] * OD[ox, oy]).sum()
-        # TT = np.tensordot(TT, OD, axes=[(2, 3), (2, 3)])
-        return OD, average_TT
+        n_bins = int(24 / DESTINATION_PROFILE_TEMPORAL_AGGREGATION)
+        OD = np.full((7, n_bins, X_size, Y_size, X_size, Y_size), alpha)
+        TT = np.zeros((7, n_bins, X_size, Y_size, X_size, Y_size))
+        index = tuple(df[c].values for c in ["dayofweek", "hours_bin", "origin_x", "origin_y",
+                                             "destination_x", "destination_y"])
+        np.add.at(OD, index, df.demand.values)
+        TT[index] = df.trip_time.values
+        OD /= OD.sum(axis=(4, 5), keepdims=True)
+        average_TT = np.einsum('dhijkl,dhijkl->dhij', TT, OD)
+        return {'OD': OD, 'TT': average_TT}
 
-    @staticmethod
-    def load_latest_demand(t_start, t_end):
+    # Memory-mapped counts of demand_latest per update cycle, written by preprocessing/create_profile.py
+    @classmethod
+    def get_latest_demand_store(cls):
+        if not cls.latest_demand_loaded:
+            counts_path = os.path.join(DATA_DIR, 'latest_demand.npy')
+            index_path = os.path.join(DATA_DIR, 'latest_demand_index.npy')
+            if os.path.exists(counts_path) and os.path.exists(index_path):
+                first_bin, cycle = np.load(index_path).tolist()
+                cls.latest_demand_store = np.load(counts_path, mmap_mode='r'), first_bin, cycle
+            cls.latest_demand_loaded = True
+        return cls.latest_demand_store
+
+    # Falls back to the demand_latest table for windows not aligned to the store's cycle or outside it
+    @classmethod
+    def load_latest_demand(cls, t_start, t_end):
+        store = cls.get_latest_demand_store()
+        if store is not None:
+            counts, first_bin, cycle = store
+            start, end = t_start // cycle - first_bin + 1, t_end // cycle - first_bin + 1
+            if t_start % cycle == 0 and t_end % cycle == 0 and 0 <= start and end <= len(counts):
+                return counts[start:end].sum(axis=0, dtype=np.float64)
         query = """
           SELECT x, y, demand
           FROM demand_latest
@@ -3,10 +3,15 @@ from novelties import status_codes
 from common import mesh
 from common.geoutils import great_circle_distance
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 from config.settings import MAP_WIDTH, MAP_HEIGHT
 from simulator.services.routing_service import RoutingEngine
 import pandas as pd
+from scipy.sparse import csr_matrix
 from simulator.models.vehicle.vehicle_repository import VehicleRepository
+from dummy_agent.vehicle_index import VehicleGridIndex
+from dummy_agent.cell_matching import GreedyCellSolver, OptimalCellSolver, round_arrays, match_cells
 
 class MatchingPolicy(object):
     def match(self, current_time, vehicles, requests):
@@ -21,11 +26,7 @@ class MatchingPolicy(object):
             (vehicles.status == status_codes.V_CRUISING)) &
             (vehicles.idle_duration > 0)
         ]
-        v_list = []
-        for index, v in idle_vehicles.iterrows():
-            if v['current_capacity'] != v['max_capacity']:
-                v_list.append(v)
-        return pd.DataFrame(v_list)
+        return idle_vehicles[idle_vehicles.current_capacity != idle_vehicles.max_capacity]
 
     # Craeting matching dictionary assciated with each vehicle ID
     def create_matching_dict(self, vehicle_id, customer_id, duration, distance):
@@ -43,13 +44,9 @@ class MatchingPolicy(object):
             (vehicles.idle_duration > 0)
         ]
         # print(type(idle_vehicles))
-        v_list = []
-        v_capacity = []
-        for index, v in idle_vehicles.iterrows():
-            if v['current_capacity'] != v['max_capacity']:
-                v_list.append(v)
-                v_capacity.append(v['max_capacity'] - v['current_capacity'])
-        return pd.DataFrame(v_list), v_capacity
+        idle_vehicles = idle_vehicles[idle_vehicles.current_capacity != idle_vehicles.max_capacity]
+        v_capacity = (idle_vehicles.max_capacity - idle_vehicles.current_capacity).tolist()
+        return idle_vehicles, v_capacity
 
 
 class RoughMatchingPolicy(MatchingPolicy):
@@ -84,14 +81,17 @@ class RoughMatchingPolicy(MatchingPolicy):
 
 
 class GreedyMatchingPolicy(MatchingPolicy):
-    def __init__(self, reject_distance=5000):
+    def __init__(self, reject_distance=5000, n_workers=0):
         self.reject_distance = reject_distance  # meters
         self.reject_wait_time = 15 * 60         # seconds
         self.k = 3                              # the number of mesh to aggregate
         self.unit_length = 500                  # mesh size in meters
         self.max_locations = 40                 # max number of origin/destination points
         self.routing_engine = RoutingEngine.create_engine()
-
+        self.vehicle_index = VehicleGridIndex(self.k)
+        self.cell_solver = GreedyCellSolver(self.reject_wait_time)
+        self.n_workers = n_workers              # processes solving independent cells in match_RS, 0 to solve in place
+        self.executor = None
 
     def get_coord(self, lon, lat):
         x, y = mesh.convert_lonlat_to_xy(lon, lat)
@@ -103,18 +103,21 @@ class GreedyMatchingPolicy(MatchingPolicy):
                 yield (x, y)
 
     # Candidate Vehicle IDs from the mesh
-    def find_candidates(self, coord, n_requests, V, reject_range):
-        x, y = coord
-        candidate_vids = V[(x, y)][:]
-        for r in range(1, reject_range):
-            for dx in range(-r, r + 1):
-                for dy in range(-r, r + 1):
-                    r_2 = dx ** 2 + dy ** 2
-                    if r ** 2 <= r_2 and r_2 < (r + 1) ** 2:
-                        candidate_vids += V[(x + dx, y + dy)][:]
-                if len(candidate_vids) > n_requests * 2:
-                    break
-        return candidate_vids
+    def find_candidates(self, coord, n_requests, reject_range):
+        return self.vehicle_index.find(coord, n_requests, reject_range)
+
+    # Bring the vehicle index up to date with the available vehicles of this round, looking only at the vehicles
+    # that changed since the previous round
+    def update_vehicle_index(self, all_vehicles, vehicles):
+        pending = self.vehicle_index.pending(VehicleRepository.pop_changed_ids())
+        pending = np.fromiter(pending, dtype=np.int64, count=len(pending))
+        fleet_pos = all_vehicles.index.get_indexer(pending)
+        in_fleet = fleet_pos >= 0
+        ids = pending[in_fleet][np.argsort(fleet_pos[in_fleet])]
+        pos = vehicles.index.get_indexer(ids)
+        available = pos >= 0
+        pos = pos[available]
+        self.vehicle_index.sync(pending[~in_fleet], ids, available, vehicles.lon.values[pos], vehicles.lat.values[pos])
 
     # Returns list of assignments
     def assign_nearest_vehicle(self, request_ids, vehicle_ids, T, dist):
@@ -147,95 +150,16 @@ class GreedyMatchingPolicy(MatchingPolicy):
         d = d[within_limit_distance]
         return candidates[np.argsort(d)[:2 * len(requests) + 1]].tolist()
 
-    def assign_nearest_vehicle_RideShare(self, request_ids, all_target_ridx, requestAssigned, vehicle_ids, vehicle_idx,
-                                         T, TRR, TDD, dist, d_RR, d_DD):
-        assignments = []
-        # for ri, rid in enumerate(request_ids):
-        # vi = T[ri,vehicle_idx].argmin()
-        # tt = T[ri,vehicle_idx][vi]
-        # for rid in request_ids:
-        # print(len(request_ids), type(request_ids))
-        # print(len(all_target_ridx), len(vehicle_ids), len(vehicle_idx))
-
-        # for ri, rid in enumerate(request_ids):
-        for rid in request_ids:
-            ri = all_target_ridx[rid]
-            # For this request ri, pick the min from all candidate vehicles
-            vi = T[ri, vehicle_idx].argmin()
-            tt = T[ri, vehicle_idx][vi]
-
-            # print("D: ", dist, "shape: ", dist.shape)
-            # print("Ri:", ri,  "Vi: ", vehicle_idx, len(vehicle_idx))
-            # print("Filtered: ", dist[ri, vehicle_idx])
-            # print(type(dist))
-            di = dist[ri, vehicle_idx].argmin()
-            dd = dist[ri, vehicle_idx][di]
-            # else:
-            # dd = dist
-
-            # print(T[ri])
-            # print(vehicle_idx)
-            # print(T[ri,vehicle_idx])
-            # print("RTT","Ri",ri,"Vi",vi,vehicle_ids,tt)
-            if tt > self.reject_wait_time:
-                continue
-
-            vid = vehicle_ids[vi]
-            vi = vehicle_idx[vi]
-
-            # print("RTT","VID",vid,"Vix",vi)
-
-            vehicle = VehicleRepository.get(vid)
-            if (vehicle.reachedCapacity() == False):
-                if (len(requestAssigned[vid]) == 0):
-                    requestAssigned[vid].append(rid)
-                    # vehicle.state.current_capacity += 1
-                    # print("1: ", dd)
-                    assignments.append((vid, rid, tt, dd))
-                    # print("TT",T[:, vi])
-                    # print("TRR",TRR[:, ri])
-                    T[:, vi] = T[:, vi] + TRR[:, ri]
-                    dist[:, vi] = d_RR[:, ri]
-                    # T[ri, vi] = T[ri, vi] + tt
-                    # print("TTA",T[:, vi])
-                else:
-                    ll = list(requestAssigned[vid])
-                    # print("LL",ll)
-                    ll.append(rid)
-                    # print("RS",requestAssigned[vid])
-                    ll_x = [all_target_ridx[r] for r in ll]
-                    maxdd = TDD[ll_x][:, ll_x].max()
-                    # extra_d = d_DD[ll_x][:, ll_x].max()
-                    # print("LLAfter",ll, "Max Time",maxdd,flush=True)
-                    if (maxdd <= self.reject_wait_time):
-                        requestAssigned[vid].append(rid)
-                        # vehicle.increaseCapacity()
-                        assignments.append((vid, rid, tt, dd))
-                        # print("Nxt: ", dd)
-                        # print("TT",T[:, vi])
-                        T[:, vi] = T[:, vi] + TRR[:, ri]
-                        dist[:, vi] = d_RR[:, ri]
-                        # T[ri, vi] = T[ri, vi] + tt
-                        # print("TTA",T[:, vi])
-            else:
-                T[:, vi] = float('inf')
-                dist[:, vi] = float('inf')
-        return assignments
-
     def match(self, current_time, vehicles, requests):
         match_list = []
+        all_vehicles = vehicles
         vehicles = self.find_available_vehicles(vehicles)
+        self.update_vehicle_index(all_vehicles, vehicles)
         n_vehicles = len(vehicles)
         if n_vehicles == 0:
             return match_list
 
         v_latlon = vehicles[["lat", "lon"]]
-        V = defaultdict(list)
-        vid2coord = {}
-        for vid, row in v_latlon.iterrows():
-            coord = self.get_coord(row.lon, row.lat)
-            vid2coord[vid] = coord
-            V[coord].append(vid)
 
         r_latlon = requests[["origin_lat", "origin_lon"]]
         R = defaultdict(list)
@@ -252,7 +176,7 @@ class GreedyMatchingPolicy(MatchingPolicy):
                 #
                 target_rids = R[coord][i * self.max_locations : (i + 1) * self.max_locations]
 
-                candidate_vids = self.find_candidates(coord, len(target_rids), V, reject_range)
+                candidate_vids = self.find_candidates(coord, len(target_rids), reject_range)
                 if len(candidate_vids) == 0:
                     continue
 
@@ -270,15 +194,15 @@ class GreedyMatchingPolicy(MatchingPolicy):
                 assignments = self.assign_nearest_vehicle(target_rids, candidate_vids, T.T, dist.T)
                 for vid, rid, tt, d in assignments:
                     match_list.append(self.create_matching_dict(vid, rid, tt, d))
-                    V[vid2coord[vid]].remove(vid)
+                    self.vehicle_index.remove(vid)
 
         return match_list
 
     def match_RS(self, current_time, vehicles, requests):
         # print("SA: Inside GreedyMatching Match ", "V:", len(vehicles), "R:", len(requests))
         commands = []
-        requestAssigned = defaultdict(list)
 
+        all_vehicles = vehicles
         vehicles, cap_list = self.find_available_vehicles_RS(vehicles)
 
         n_vehicles = len(vehicles)
@@ -290,27 +214,13 @@ class GreedyMatchingPolicy(MatchingPolicy):
 
         # print("SA: Inside GreedyMatching Match ", "V:", len(vehicles), "R:", len(requests))
 
+        self.update_vehicle_index(all_vehicles, vehicles)
         if n_vehicles == 0:
             return commands
 
         # print("Available Vehicles and grid locations")
         v_latlon = vehicles[["lat", "lon"]]
-        V = defaultdict(list)
-        vid2coord = {}
-        all_candidate_vids = []
-        # all_candidate_vidx = {}
-        # vcnt = 0
-        for vid, row in v_latlon.iterrows():
-            # print("AAAA")
-            # print(vehicles.loc[vid])
-            # print(vid, row.lon, row.lat)
-            coord = self.get_coord(row.lon, row.lat)
-            vid2coord[vid] = coord
-            # print(vid, coord)
-            V[coord].append(vid)
-            all_candidate_vids.append(vid)
-            # all_candidate_vidx[vid] = vcnt
-            # vcnt = vcnt+1
+        all_candidate_vids = v_latlon.index.tolist()
 
         # print("Requests and Grid locations")
         r_latlon = requests[["origin_lat", "origin_lon"]]
@@ -339,63 +249,71 @@ class GreedyMatchingPolicy(MatchingPolicy):
         all_target_latlon = r_latlon.loc[all_target_rids]
         # print("Target List: ", len(all_target_latlon))
         all_destination_latlon = r_latlon.loc[all_target_rids]
-        T, dist = self.eta_matrix(candidate_latlon, all_target_latlon)
-        # print("match_D: ", dist, dist.shape)
-        TRR, Dist_RR = self.eta_matrix(all_target_latlon, all_target_latlon)
-        TDD, Dist_DD = self.eta_matrix(all_destination_latlon, all_destination_latlon)
+        # Only the pairs within reject_distance are kept; each cell works on dense blocks of its own requests and
+        # candidate vehicles, see cell_matching.cell_blocks
+        T = self.sparse_eta_matrix(candidate_latlon, all_target_latlon)
+        TRR = self.sparse_eta_matrix(all_target_latlon, all_target_latlon)
+        TDD = self.sparse_eta_matrix(all_destination_latlon, all_destination_latlon)
 
         # for vid, row in vehicles.iterrows():
         # row.earnings = 10
         # print(type(row))
         # print(vehicles[["id"]])
         # print(vid, row.earnings, row.lon, row.lat, row.status)
+        # Candidate sets only depend on this round's vehicles, so all the cells are collected first
+        cell_ids, cells = [], []
         for coord in self.coord_iter():
-            # print("SA: Inside COORD")
-            # print(dist.shape)
-            # print(T.shape)
             if not R[coord]:
-                # print(coord, "does not exist")
                 continue
-            # print(coord, "exists")
-            # for i in range(int(np.ceil(len(R[coord]) / self.max_locations))):
-            # target_rids = R[coord][i * self.max_locations : (i + 1) * self.max_locations]
-            # for i in range(int(np.ceil(len(R[coord]) / self.max_locations))):
             target_rids = R[coord]
-            # print("TR: ", target_rids)
-            candidate_vids = self.find_candidates(coord, len(target_rids), V, reject_range)
-            # print("Cand. Vehicles: ", len(candidate_vids))
+            candidate_vids = self.find_candidates(coord, len(target_rids), reject_range)
             if len(candidate_vids) == 0:
                 continue
 
             target_latlon = r_latlon.loc[target_rids]
             candidate_vids = self.filter_candidates(v_latlon.loc[candidate_vids], target_latlon)
-            # print("Filtered Vehicles: ", len(candidate_vids))
             if len(candidate_vids) == 0:
                 continue
-
-            requestAssigned = defaultdict(list)
             # All candiaidate vehicles that can pickup this specific customer
             candidate_vidx = [all_candidate_vidx[v] for v in candidate_vids]
-            assignments = self.assign_nearest_vehicle_RideShare(target_rids, all_target_ridx, requestAssigned,
-                                                                candidate_vids,
-                                                                candidate_vidx, T.T, TRR, TDD, dist.T, Dist_RR, Dist_DD)
-            for vid, rid, tt, d in assignments:
+            full = np.array([VehicleRepository.get(vid).reachedCapacity() for vid in candidate_vids])
+            cell_ids.append((target_rids, candidate_vids))
+            cells.append(([all_target_ridx[r] for r in target_rids], candidate_vidx, full))
+
+        arrays = round_arrays(T, TRR, TDD, candidate_latlon.values, all_target_latlon.values)
+        cell_assignments = match_cells(self.cell_solver, arrays, cells, self.get_executor(), self.n_workers)
+        for (target_rids, candidate_vids), assignments in zip(cell_ids, cell_assignments):
+            for vi, ri, tt, d in assignments:
+                vid, rid = candidate_vids[vi], target_rids[ri]
                 commands.append(self.create_matching_dict(vid, rid, tt, d))
-                # vehicles[vid].current_capacity = vehicles[vid].current_capacity +1
-                # print("COORD:", coord, "V ", vid, "assigned to R", rid)
                 vehicle = VehicleRepository.get(vid)
-                # vehicle.state.current_capacity += 1
-                # vehicle.print_vehicle()
-                # print(vehicle)
-
-                # vehicles[vid].update_capacity()
-                # if vid in V[vid2coord[vid]]:
-                #   V[vid2coord[vid]].remove(vid)
-                if vehicle.state.current_capacity >= vehicle.state.max_capacity and vid in V[vid2coord[vid]]:
-                    V[vid2coord[vid]].remove(vid)
+                if vehicle.state.current_capacity >= vehicle.state.max_capacity:
+                    self.vehicle_index.remove(vid)
 
         return commands
 
+    # ETAs between the pairs of origins and destinations within reject_distance, as a sparse matrix holding
+    # explicit zeros: a pair is held whether or not its ETA is zero
+    def sparse_eta_matrix(self, origins_array, destins_array):
+        rows, cols, T, _ = self.routing_engine.eta_many_to_many(origins_array.values, destins_array.values,
+                                                                max_distance=self.reject_distance, sparse=True)
+        T = T.astype(np.float32)
+        T[np.isnan(T)] = float('inf')
+        return csr_matrix((T, (rows, cols)), shape=(len(origins_array), len(destins_array)))
+
+    # Worker processes solving independent cells, started on first use
+    def get_executor(self):
+        if self.n_workers < 1:
+            return None
+        if self.executor is None:
+            # Spawned, as the simulator process holds threads and a TensorFlow session
+            self.executor = ProcessPoolExecutor(self.n_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
     def eta_matrix(self, origins_array, destins_array):
         destins = [(lat, lon) for lat, lon in destins_array.values]
@@ -411,3 +329,28 @@ class GreedyMatchingPolicy(MatchingPolicy):
         # print("D: ", d.shape)
         return [T, d]
 
+
+class OptimalMatchingPolicy(GreedyMatchingPolicy):
+    """Solves the ETA matrix of each cell cluster as one assignment problem instead of request by request.
+
+    The assignment maximizes the number of requests served within reject_wait_time, then minimizes the total
+    pickup time. Clusters up to the size match() builds (max_locations requests and their 2 * max_locations + 1
+    candidates) use the Hungarian method on the dense matrix; the larger cells of match_RS only keep the
+    n_nearest candidate vehicles of each request and solve a sparse min-cost matching.
+    """
+    def __init__(self, reject_distance=5000, n_nearest=10, dense_limit=None, n_workers=0):
+        super().__init__(reject_distance, n_workers)
+        if dense_limit is None:
+            dense_limit = self.max_locations * (2 * self.max_locations + 1)
+        self.cell_solver = OptimalCellSolver(self.reject_wait_time, n_nearest, dense_limit)
+
+    # Returns the (request index, vehicle index) pairs of the assignment, T is (requests, vehicles)
+    def solve_assignment(self, T):
+        return self.cell_solver.solve_assignment(T)
+
+    # Returns list of assignments
+    def assign_nearest_vehicle(self, request_ids, vehicle_ids, T, dist):
+        assignments = []
+        for ri, vi in zip(*self.solve_assignment(T)):
+            assignments.append((vehicle_ids[vi], request_ids[ri], T[ri, vi], dist[ri, vi]))
+        return assignments
@@ -0,0 +1,97 @@
+import numpy as np
+from common import mesh
+from config.settings import MAP_HEIGHT
+
+
+class VehicleGridIndex(object):
+    """Available vehicles bucketed by the matcher's k-aggregated mesh cell, kept across matching rounds.
+
+    sync() only looks at the vehicles whose state changed since the previous round and at the ones removed by
+    the matcher. Queries return bucket ids in fleet order, so they give the same candidates, in the same order,
+    as a grid rebuilt from the vehicles frame.
+    """
+    def __init__(self, k):
+        self.k = k
+        self.n_y = (MAP_HEIGHT - 1) // k + 1
+        self.coords = {}        # Cell of each indexed vehicle id
+        self.rank = {}          # Rank of each vehicle id in the fleet
+        self.n_seen = 0
+        self.buckets = {}       # Cell to set of vehicle ids
+        self.sorted = {}        # Cell to its vehicle ids in fleet order, cached until the bucket changes
+        self.removed = set()    # Vehicles removed by remove() since the last sync
+        self.rings = {}
+        self.empty = np.empty(0, dtype=np.int64)
+
+    # Vehicles sync has to look at, given those whose state changed
+    def pending(self, changed_ids):
+        pending = self.removed | set(changed_ids)
+        self.removed = set()
+        return pending
+
+    # ids: the pending vehicles that are still in the fleet, in fleet order; available: whether each can be matched;
+    # lons, lats: locations of the available ones
+    def sync(self, gone_ids, ids, available, lons, lats):
+        for vid in gone_ids:
+            self.__discard(vid)
+            self.rank.pop(vid, None)
+        ids = np.asarray(ids, dtype=np.int64)
+        available = np.asarray(available, dtype=bool)
+        for vid in ids.tolist():
+            if vid not in self.rank:
+                self.rank[vid] = self.n_seen     # Vehicles join the fleet at its end
+                self.n_seen += 1
+        for vid in ids[~available].tolist():
+            self.__discard(vid)
+        xs = (mesh.lon2X(np.asarray(lons)) // self.k).tolist()
+        ys = (mesh.lat2Y(np.asarray(lats)) // self.k).tolist()
+        for vid, coord in zip(ids[available].tolist(), zip(xs, ys)):
+            if self.coords.get(vid) != coord:
+                self.__discard(vid)
+                self.buckets.setdefault(coord, set()).add(vid)
+                self.sorted.pop(coord, None)
+                self.coords[vid] = coord
+
+    def __discard(self, vid):
+        coord = self.coords.pop(vid, None)
+        if coord is not None:
+            self.buckets[coord].discard(vid)
+            self.sorted.pop(coord, None)
+
+    # Takes a matched vehicle out until the next sync checks it again
+    def remove(self, vid):
+        self.__discard(vid)
+        self.removed.add(vid)
+
+    def get(self, coord):
+        ids = self.sorted.get(coord)
+        if ids is None:
+            bucket = self.buckets.get(coord)
+            if not bucket:
+                return self.empty
+            ids = np.array(sorted(bucket, key=self.rank.__getitem__), dtype=np.int64)
+            self.sorted[coord] = ids
+        return ids
+
+    # Offsets of the cells at ring distance r, grouped by dx
+    def __ring(self, r):
+        if r not in self.rings:
+            columns = []
+            for dx in range(-r, r + 1):
+                columns.append([(dx, dy) for dy in range(-r, r + 1) if r ** 2 <= dx ** 2 + dy ** 2 < (r + 1) ** 2])
+            self.rings[r] = columns
+        return self.rings[r]
+
+    # Vehicle ids in the cell and in the rings around it, until there are enough for n_requests
+    def find(self, coord, n_requests, reject_range):
+        x, y = coord
+        candidates = [self.get(coord)]
+        n = len(candidates[0])
+        for r in range(1, reject_range):
+            for column in self.__ring(r):
+                for dx, dy in column:
+                    bucket = self.get((x + dx, y + dy))
+                    candidates.append(bucket)
+                    n += len(bucket)
+                if n > n_requests * 2:
+                    break
+        return np.concatenate(candidates)
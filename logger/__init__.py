@@ -6,10 +6,15 @@ import yaml
 config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logging.yaml')
 
 class SimulationLogger(object):
+    log_dir = None      # Overrides the directory of the log files in the config, e.g. one per actor process
 
     def setup_logging(self, env, path=config_path, level=logging.INFO):
         with open(path, 'rt') as f:
             config = yaml.safe_load(f.read())
+        if self.log_dir is not None:
+            for handler in config['handlers'].values():
+                if 'filename' in handler:
+                    handler['filename'] = os.path.join(self.log_dir, os.path.basename(handler['filename']))
         logging.config.dictConfig(config)
         self.vehicle_logger = getLogger('vehicle')
         self.customer_logger = getLogger('customer')
@@ -7,7 +7,7 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/../')
 from db import engine, Session
 from common.time_utils import get_local_datetime
-from config.settings import MIN_LAT, MIN_LON, DELTA_LAT, DELTA_LON, MAP_WIDTH, MAP_HEIGHT,\
+from config.settings import DATA_DIR, MIN_LAT, MIN_LON, DELTA_LAT, DELTA_LON, MAP_WIDTH, MAP_HEIGHT,\
     GLOBAL_STATE_UPDATE_CYCLE, DESTINATION_PROFILE_TEMPORAL_AGGREGATION, DESTINATION_PROFILE_SPATIAL_AGGREGATION
 # from dqn_agent.settings import FLAGS
 
@@ -94,7 +94,7 @@ def create_od_profile(df, profile_table, n_weeks):
     Session.commit()
 
 
-def create_latest_demand(source_table, latest_table):
+def create_latest_demand(source_table, latest_table, data_dir=None):
     query = "SELECT * FROM {}".format(source_table)
     df = pd.read_sql(query, engine, index_col="id")
     print("# of rows {}".format(len(df)))
@@ -106,6 +106,8 @@ def create_latest_demand(source_table, latest_table):
 
     latest_df = df.groupby(['t', 'x', 'y']).size()
     latest_df.name = 'demand'
+    if data_dir is not None:
+        create_latest_demand_store(latest_df.reset_index(), data_dir)
     drop_table = """
     DROP TABLE IF EXISTS {};
     """.format(latest_table)
@@ -119,6 +121,19 @@ def create_latest_demand(source_table, latest_table):
     Session.execute(create_index)
     Session.commit()
 
+# Dense (bins, W, H) counts where bin b holds the rows with (b - 1) * cycle < t <= b * cycle,
+# and latest_demand_index holds the first bin and the cycle
+def create_latest_demand_store(latest_df, data_dir):
+    cycle = GLOBAL_STATE_UPDATE_CYCLE
+    bins = np.ceil(latest_df.t.values / cycle).astype(np.int64)
+    first_bin = bins.min()
+    counts = np.zeros((bins.max() - first_bin + 1, MAP_WIDTH, MAP_HEIGHT), dtype=np.int64)
+    np.add.at(counts, (bins - first_bin, latest_df.x.values, latest_df.y.values), latest_df.demand.values)
+    dtype = np.int16 if counts.max() <= np.iinfo(np.int16).max else np.int32
+    np.save("{}/latest_demand".format(data_dir), counts.astype(dtype))
+    np.save("{}/latest_demand_index".format(data_dir), np.array([first_bin, cycle], dtype=np.int64))
+
+
 def create_training_dataset(df, n_weeks):
     t_start = df.request_datetime.min()
     t_end = t_start + 3600 * 24 * 7 * n_weeks
@@ -130,6 +145,7 @@ def create_training_dataset(df, n_weeks):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("input_file", help = "path to the training data file")
+    parser.add_argument("--data_dir", default=DATA_DIR, help = "data directory for the latest demand store")
     args = parser.parse_args()
 
     df = pd.read_csv(args.input_file, index_col='id')
@@ -145,7 +161,7 @@ if __name__ == '__main__':
     create_od_profile(df, "od_profile", n_weeks)
     print("created od_profile table")
 
-    create_latest_demand("request_backlog", "demand_latest")
+    create_latest_demand("request_backlog", "demand_latest", args.data_dir)
     print("created demand_latest table")
     # t_start = 1462075200 # 160501
     # sim_datetime = 1464753600 # 160601
@@ -2,6 +2,7 @@ import numpy as np
 import argparse
 import sys
 import pickle
+import polyline
 sys.path.append('/../data')
 sys.path.append('C:/Users/17657/PycharmProjects/Deep_Pool')
 from simulator.services.osrm_engine import OSRMEngine
@@ -74,13 +75,44 @@ def create_routes(engine, reachable_map):
     return routes
 
 
+# Flat binary route store: all decoded routes in one (N, 2) float32 array of (lat, lon),
+# with an (x, y, axi, ayi) -> (offset, length) index into it. FastRoutingEngine memory-maps both files.
+def create_route_store(routes, data_dir):
+    a_size = MAX_MOVE * 2 + 1
+    route_index = np.zeros((MAP_WIDTH, MAP_HEIGHT, a_size, a_size, 2), dtype=np.int64)
+    coords = []
+    offset = 0
+    for (x, y), actions in routes.items():
+        for (ax, ay), geometry in actions.items():
+            trajectory = np.array(polyline.decode(geometry), dtype=np.float32).reshape(-1, 2)
+            route_index[x, y, ax + MAX_MOVE, ay + MAX_MOVE] = offset, len(trajectory)
+            coords.append(trajectory)
+            offset += len(trajectory)
+    route_coords = np.concatenate(coords) if coords else np.zeros((0, 2), dtype=np.float32)
+    np.save("{}/route_coords".format(data_dir), route_coords)
+    np.save("{}/route_index".format(data_dir), route_index)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("data_dir", help = "data directory")
     # parser.add_argument("--route", action='store_true', help="whether compute route or not")
+    parser.add_argument("--convert_routes", action='store_true',
+                        help="only convert an existing routes.pkl into the binary route store")
+    parser.add_argument("--osrm_cache", type=int, default=0,
+                        help="max number of OSRM responses kept in data_dir/osrm_cache.sqlite3 (0 to disable)")
     args = parser.parse_args()
 
-    engine = OSRMEngine()
+    if args.convert_routes:
+        print("create route store")
+        routes = pickle.load(open("{}/routes.pkl".format(args.data_dir), "rb"))
+        create_route_store(routes, args.data_dir)
+        sys.exit(0)
+
+    if args.osrm_cache > 0:
+        engine = OSRMEngine(cache_path="{}/osrm_cache.sqlite3".format(args.data_dir), cache_size=args.osrm_cache)
+    else:
+        engine = OSRMEngine()
 
     print("create reachable map")
     reachable_map = create_reachable_map(engine)
@@ -94,3 +126,6 @@ if __name__ == '__main__':
     # if args.route:
     routes = create_routes(engine, reachable_map)
     pickle.dump(routes, open("{}/routes.pkl".format(args.data_dir), "wb"))
+
+    print("create route store")
+    create_route_store(routes, args.data_dir)
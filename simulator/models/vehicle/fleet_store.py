@@ -0,0 +1,151 @@
+import numpy as np
+from collections import OrderedDict
+from novelties import status_codes
+
+N_STATUS = status_codes.V_OFF_DUTY + 1
+
+
+class FleetStore(object):
+    """Structure-of-arrays storage of the fleet.
+
+    Every vehicle owns one row and every attribute is one NumPy column indexed by that row.
+    Live rows are kept contiguous and in insertion order, so view(name) is a zero-copy slice.
+    """
+    # VehicleState attributes, in the order of VehicleState.fields
+    state_columns = OrderedDict([
+        ('id', np.int64),
+        ('lat', np.float64),
+        ('lon', np.float64),
+        ('speed', np.float64),
+        ('status', np.int64),
+        ('destination_lat', np.float64),
+        ('destination_lon', np.float64),
+        ('type', np.int64),
+        ('travel_dist', np.float64),
+        ('price_per_travel_m', np.float64),
+        ('price_per_wait_min', np.float64),
+        ('gas_price', np.int64),
+        ('assigned_customer_id', np.float64),
+        ('time_to_destination', np.float64),
+        ('idle_duration', np.int64),
+        ('current_capacity', np.int64),
+        ('max_capacity', np.int64),
+        ('driver_base_per_trip', np.float64),
+        ('mileage', np.float64),
+        ('agent_type', np.int64),
+    ])
+    # Columns that decide whether and where a vehicle can be matched; writes to them are recorded in changed_ids.
+    # Only whether idle_duration is positive matters
+    tracked_columns = {'id', 'lat', 'lon', 'status', 'idle_duration', 'current_capacity', 'max_capacity'}
+    # Columns only written when the vehicle enters the fleet
+    static_columns = {'id', 'type', 'price_per_travel_m', 'price_per_wait_min', 'gas_price', 'max_capacity',
+                      'driver_base_per_trip', 'mileage', 'agent_type'}
+    # Columns that can hold None; stored as NaN
+    nullable_columns = {'destination_lat', 'destination_lon', 'assigned_customer_id'}
+    # Vehicle bookkeeping that is not part of the state vector
+    vehicle_columns = OrderedDict([
+        ('earnings', np.float64),
+        ('pickup_time', np.float64),
+        ('working_time', np.int64),
+        ('route_progress', np.float64),
+    ])
+
+    def __init__(self, capacity=1024):
+        self.capacity = max(int(capacity), 1)
+        self.n = 0
+        self.owners = []        # Object bound to each row (VehicleState), None once released
+        self.n_released = 0
+        self.columns = {}
+        for name, dtype in list(self.state_columns.items()) + list(self.vehicle_columns.items()):
+            self.columns[name] = self.__empty_column(name, dtype, self.capacity)
+        self.columns['duration'] = np.zeros((self.capacity, N_STATUS))     # Duration for each state
+        self.changed_ids = set()
+
+    def __len__(self):
+        return self.n - self.n_released
+
+    def __empty_column(self, name, dtype, size):
+        if name in self.nullable_columns:
+            return np.full(size, np.nan, dtype=dtype)
+        return np.zeros(size, dtype=dtype)
+
+    def __grow(self):
+        capacity = self.capacity * 2
+        for name, column in self.columns.items():
+            if name == 'duration':
+                grown = np.zeros((capacity, N_STATUS))
+            else:
+                grown = self.__empty_column(name, column.dtype, capacity)
+            grown[:self.n] = column[:self.n]
+            self.columns[name] = grown
+        self.capacity = capacity
+
+    def allocate(self, owner):
+        if self.n == self.capacity:
+            self.__grow()
+        row = self.n
+        self.n += 1
+        self.owners.append(owner)
+        return row
+
+    # Move the row out into a private store, so that the owner stays readable after it leaves the fleet
+    def release(self, row):
+        owner = self.owners[row]
+        detached = FleetStore(capacity=1)
+        detached.allocate(owner)
+        for name, column in self.columns.items():
+            detached.columns[name][0] = column[row]
+        owner.bind(detached, 0)
+        self.owners[row] = None
+        self.changed_ids.add(int(self.columns['id'][row]))
+        self.n_released += 1
+
+    # Close the gaps left by released rows, keeping the remaining rows in order
+    def compact(self):
+        if self.n_released == 0:
+            return
+        keep = np.array([owner is not None for owner in self.owners], dtype=bool)
+        rows = np.flatnonzero(keep)
+        n = len(rows)
+        first_moved = int(np.argmin(keep))
+        for name, column in self.columns.items():
+            column[:n] = column[rows]
+            if name == 'duration':
+                column[n:self.n] = 0
+            else:
+                column[n:self.n] = self.__empty_column(name, column.dtype, 1)[0]
+        self.owners = [self.owners[i] for i in rows]
+        for row in range(first_moved, n):
+            self.owners[row].bind(self, row)
+        self.n = n
+        self.n_released = 0
+
+    def get(self, name, row):
+        return self.columns[name][row]
+
+    def set(self, name, row, value):
+        column = self.columns[name]
+        if name in self.tracked_columns:
+            old = column[row]
+            if ((old > 0) != (value > 0)) if name == 'idle_duration' else old != value:
+                self.changed_ids.add(int(self.columns['id'][row]))
+        column[row] = value
+
+    # For writes made directly to column views
+    def mark_changed(self, rows):
+        self.changed_ids.update(self.columns['id'][rows].tolist())
+
+    def pop_changed_ids(self):
+        changed_ids, self.changed_ids = self.changed_ids, set()
+        return changed_ids
+
+    # Zero-copy view of the column over all live rows
+    def view(self, name):
+        self.compact()
+        return self.columns[name][:self.n]
+
+    # Zero-copy view that cannot be written through, valid until rows are released and compacted
+    def readonly_view(self, name):
+        column = self.view(name).view()
+        column.flags.writeable = False
+        return column
@@ -0,0 +1,68 @@
+import numpy as np
+from common.geoutils import great_circle_distance
+
+
+class PackedRoute(object):
+    """Cruise route packed once at dispatch time.
+
+    points: float32 array of (lat, lon), starting at the location the vehicle left from
+    cum_dist: distance in meters from the first point to each point
+    """
+    __slots__ = ['points', 'cum_dist']
+
+    def __init__(self, origin, route):
+        self.points = np.empty((len(route) + 1, 2), dtype=np.float32)
+        self.points[0] = origin
+        if len(route) > 0:
+            self.points[1:] = route
+        lats, lons = self.points[:, 0].astype(np.float64), self.points[:, 1].astype(np.float64)
+        step_dist = great_circle_distance(lats[:-1], lons[:-1], lats[1:], lons[1:])     # Distance in meters
+        self.cum_dist = np.concatenate([[0.0], np.cumsum(step_dist)])
+
+    def __len__(self):
+        return len(self.points)
+
+    # Length of the route itself, without the leg from the origin to its first point
+    def route_length(self):
+        if len(self.points) < 2:
+            return 0.0
+        return self.cum_dist[-1] - self.cum_dist[1]
+
+    # Index of the first point not reached yet after driving the given distance
+    def next_index(self, distance):
+        return int(np.searchsorted(self.cum_dist, distance, side='right'))
+
+    # Location after driving the given distance from the origin
+    def locate(self, distance):
+        i = self.next_index(distance)
+        if i >= len(self.points):
+            return tuple(self.points[-1].astype(np.float64))
+        start, end = self.points[i - 1].astype(np.float64), self.points[i].astype(np.float64)
+        frac = (distance - self.cum_dist[i - 1]) / (self.cum_dist[i] - self.cum_dist[i - 1])
+        return tuple(start + frac * (end - start))
+
+    # View of the points still ahead, no copy
+    def remaining(self, distance):
+        return self.points[self.next_index(distance):]
+
+
+def locate_many(routes, distances):
+    """PackedRoute.locate for many routes at once, returns arrays of lats and lons."""
+    lengths = np.array([len(route) for route in routes])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    cum_dist = np.concatenate([route.cum_dist for route in routes])
+    points = np.concatenate([route.points for route in routes]).astype(np.float64)
+    owner = np.repeat(np.arange(len(routes)), lengths)
+    # Same as searchsorted(side='right') on each route
+    i = np.add.reduceat((cum_dist <= distances[owner]).astype(np.int64), starts)
+
+    at_end = i >= lengths
+    a = starts + np.where(at_end, lengths - 1, i - 1)
+    b = starts + np.where(at_end, lengths - 1, i)
+    frac = np.zeros(len(routes))
+    moving = ~at_end
+    frac[moving] = (distances[moving] - cum_dist[a[moving]]) / (cum_dist[b[moving]] - cum_dist[a[moving]])
+    start, end = points[a], points[b]
+    location = start + frac[:, None] * (end - start)
+    location[at_end] = points[a[at_end]]
+    return location[:, 0], location[:, 1]
@@ -1,7 +1,7 @@
 from novelties import status_codes
-from common import geoutils
 from config.settings import MIN_WORKING_TIME, MAX_WORKING_TIME
 from .vehicle_state import VehicleState
+from .route import PackedRoute
 from .vehicle_behavior import Occupied, Cruising, Idle, Assigned, OffDuty
 from logger import sim_logger
 from logging import getLogger
@@ -27,14 +27,53 @@ class Vehicle(object):
         self.__behavior = self.behavior_models[vehicle_state.status]
         self.__customers = []       # A vehicle can have a list of cusotmers
         self.__customers_ids = []
-        self.__route_plan = []
+        self.__route_plan = None   # PackedRoute while cruising
         self.earnings = 0
         self.working_time = 0
         self.epsilon = 5
         self.first_dispatched = 0
         self.pickup_time = 0
         self.q_action_dict = {}
-        self.duration = np.zeros(len(self.behavior_models))     # Duration for each state
+        # Duration for each state is kept in the fleet store next to the state vector
+
+    # Bookkeeping columns stored in the same FleetStore row as the state
+    @property
+    def earnings(self):
+        return self.state.store.get('earnings', self.state.row)
+
+    @earnings.setter
+    def earnings(self, value):
+        self.state.store.set('earnings', self.state.row, value)
+
+    @property
+    def working_time(self):
+        return self.state.store.get('working_time', self.state.row)
+
+    @working_time.setter
+    def working_time(self, value):
+        self.state.store.set('working_time', self.state.row, value)
+
+    @property
+    def pickup_time(self):
+        return self.state.store.get('pickup_time', self.state.row)
+
+    @pickup_time.setter
+    def pickup_time(self, value):
+        self.state.store.set('pickup_time', self.state.row, value)
+
+    # Meters driven along the current route plan
+    @property
+    def route_progress(self):
+        return self.state.store.get('route_progress', self.state.row)
+
+    @route_progress.setter
+    def route_progress(self, value):
+        self.state.store.set('route_progress', self.state.row, value)
+
+    @property
+    def duration(self):
+        # Row view, in-place updates write through to the store
+        return self.state.store.get('duration', self.state.row)
 
     # state changing methods
     def step(self, timestep):
@@ -65,12 +104,20 @@ class Vehicle(object):
             logger.error(self.state.to_msg())
             raise
 
+    # Arrival transition only, used by the batched fleet step once the arrival is already applied
+    def arrive(self):
+        try:
+            self.__behavior.arrive(self)
+        except:
+            logger = getLogger(__name__)
+            logger.error(self.state.to_msg())
+            raise
+
     def compute_speed(self, route, triptime):
-        lats, lons = zip(*route)
-        distance = geoutils.great_circle_distance(lats[:-1], lons[:-1], lats[1:], lons[1:])     # Distance in meters
-        speed = sum(distance) / triptime
+        distance = route.route_length()     # Distance in meters
+        speed = distance / triptime
         # print("Dispatch!")
-        self.state.travel_dist += sum(distance)
+        self.state.travel_dist += distance
         return speed
 
     def compute_fuel_consumption(self):
@@ -138,9 +185,10 @@ class Vehicle(object):
 
     def cruise(self, route, triptime):
         assert self.__behavior.available
-        speed = self.compute_speed(route, triptime)
+        packed_route = PackedRoute(self.get_location(), route)
+        speed = self.compute_speed(packed_route, triptime)
         self.__reset_plan()
-        self.__set_route(route, speed)
+        self.__set_route(packed_route, speed)
         self.__set_destination(route[-1], triptime)
         self.__change_to_cruising()
         self.__log()
@@ -224,9 +272,15 @@ class Vehicle(object):
         self.__change_to_idle()
         self.__log()
 
-    def update_location(self, location, route):
+    def update_location(self, location):
         self.state.lat, self.state.lon = location
-        self.__route_plan = route
+
+    # Drive the given distance further along the route plan
+    def advance(self, distance):
+        if self.__route_plan is None:
+            return
+        self.route_progress += distance
+        self.update_location(self.__route_plan.locate(self.route_progress))
 
     def update_customers(self, customer):
         # customer.ride_on()
@@ -284,7 +338,7 @@ class Vehicle(object):
 
     def print_vehicle(self):
         print("\n Vehicle Info")
-        for attr in self.state.__slots__:
+        for attr in self.state.fields:
             print(attr, " ", getattr(self.state, attr))
 
         print("IDS::", self.__customers_ids)
@@ -298,8 +352,14 @@ class Vehicle(object):
         print("current_capacity", self.state.current_capacity)
         # print(self.duration)
 
+    # Points of the route plan still ahead, as a view into the packed route
     def get_route(self):
-        return self.__route_plan[:]
+        if self.__route_plan is None:
+            return []
+        return self.__route_plan.remaining(self.route_progress)
+
+    def get_route_plan(self):
+        return self.__route_plan
 
     def get_total_dist(self):
         return self.state.travel_dist
@@ -314,7 +374,7 @@ class Vehicle(object):
 
     def get_state(self):
         state = []
-        for attr in self.state.__slots__:
+        for attr in self.state.fields:
             state.append(getattr(self.state, attr))
         return state
 
@@ -340,7 +400,8 @@ class Vehicle(object):
 
     def __reset_plan(self):
         self.state.reset_plan()
-        self.__route_plan = []
+        self.__route_plan = None
+        self.route_progress = 0
 
     def __set_route(self, route, speed):
         # assert self.get_location() == route[0]
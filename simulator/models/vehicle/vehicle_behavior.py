@@ -1,5 +1,4 @@
 import simulator.models.customer.customer_repository
-from common import geoutils
 from simulator.settings import FLAGS
 
 class VehicleBehavior(object):
@@ -8,6 +7,10 @@ class VehicleBehavior(object):
     def step(self, vehicle, timestep):
         pass
 
+    # Transition once the vehicle reaches its destination
+    def arrive(self, vehicle):
+        pass
+
 
 class Idle(VehicleBehavior):
     pass
@@ -18,28 +21,19 @@ class Cruising(VehicleBehavior):
     def step(self, vehicle, timestep):
         arrived = vehicle.update_time_to_destination(timestep)
         if arrived:
-            vehicle.park()
+            self.arrive(vehicle)
             return
 
         self.drive(vehicle, timestep)
 
+    def arrive(self, vehicle):
+        vehicle.park()
 
+
+    # Position is interpolated on the cumulative distance of the packed route
     def drive(self, vehicle, timestep):
-        route = vehicle.get_route()      # Sequence of (lon, lat)
         speed = vehicle.get_speed()
-        dist_left = timestep * speed    # Remaining Distance
-        rlats, rlons = zip(*([vehicle.get_location()] + route)) # New vehicle location after driving this route
-        step_dist = geoutils.great_circle_distance(rlats[:-1], rlons[:-1], rlats[1:], rlons[1:])    # Get distcnace in meters
-        for i, d in enumerate(step_dist):
-            if dist_left < d:
-                bearing = geoutils.bearing(rlats[i], rlons[i], rlats[i + 1], rlons[i + 1])      # Calculate angle of motion
-                next_location = geoutils.end_location(rlats[i], rlons[i], dist_left, bearing)   # Calculate nxt location
-                vehicle.update_location(next_location, route[i + 1:])           # Updating location based on route's nxt (lon, lat)
-                return
-            dist_left -= d
-
-        if len(route) > 0:
-            vehicle.update_location(route[-1], [])  # Go the last step
+        vehicle.advance(timestep * speed)
 
 
 class Occupied(VehicleBehavior):
@@ -48,10 +42,13 @@ class Occupied(VehicleBehavior):
     def step(self, vehicle, timestep):
         arrived = vehicle.update_time_to_destination(timestep)
         if arrived:
-            # customer = vehicle.dropoff()
-            # customer.get_off()
-            vehicle.dropoff()
-            # env.models.customer.customer_repository.CustomerRepository.delete(customer.get_id())
+            self.arrive(vehicle)
+
+    def arrive(self, vehicle):
+        # customer = vehicle.dropoff()
+        # customer.get_off()
+        vehicle.dropoff()
+        # env.models.customer.customer_repository.CustomerRepository.delete(customer.get_id())
 
 
 class Assigned(VehicleBehavior):
@@ -60,23 +57,26 @@ class Assigned(VehicleBehavior):
     def step(self, vehicle, timestep):
         arrived = vehicle.update_time_to_destination(timestep)
         if arrived:
-            if FLAGS.enable_pooling:
-                # print("Assigned, pooling!")
-                ids = vehicle.get_customers_ids()
-                # print("Arrived: Vehicle Info", vehicle.to_string())
-                # print("Customer ids:", ids)
-                for i in range(len(ids)):
-                    customer = simulator.models.customer.customer_repository.CustomerRepository.get(ids[i])
-                    # print("Customer Info:", customer.to_string())
-                    customer.ride_on()
-                    vehicle.update_customers(customer)
-                    if i == len(ids) - 1:
-                        vehicle.pickup(customer)
-            else:
-                # print("Assigned, not pooling!")
-                customer = simulator.models.customer.customer_repository.CustomerRepository.get(
-                vehicle.get_assigned_customer_id())
-                vehicle.pickup(customer)
+            self.arrive(vehicle)
+
+    def arrive(self, vehicle):
+        if FLAGS.enable_pooling:
+            # print("Assigned, pooling!")
+            ids = vehicle.get_customers_ids()
+            # print("Arrived: Vehicle Info", vehicle.to_string())
+            # print("Customer ids:", ids)
+            for i in range(len(ids)):
+                customer = simulator.models.customer.customer_repository.CustomerRepository.get(ids[i])
+                # print("Customer Info:", customer.to_string())
+                customer.ride_on()
+                vehicle.update_customers(customer)
+                if i == len(ids) - 1:
+                    vehicle.pickup(customer)
+        else:
+            # print("Assigned, not pooling!")
+            customer = simulator.models.customer.customer_repository.CustomerRepository.get(
+            vehicle.get_assigned_customer_id())
+            vehicle.pickup(customer)
 
 class OffDuty(VehicleBehavior):
     available = False
@@ -84,4 +84,8 @@ class OffDuty(VehicleBehavior):
     def step(self, vehicle, timestep):
         returned = vehicle.update_time_to_destination(timestep)
         if returned:
-            vehicle.park()
+            self.arrive(vehicle)
+
+    def arrive(self, vehicle):
+        vehicle.park()
+
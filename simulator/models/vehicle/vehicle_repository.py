@@ -1,17 +1,24 @@
 from .vehicle import Vehicle
 from .vehicle_state import VehicleState
+from .fleet_store import FleetStore
+from .fleet_step import step_fleet
+from novelties import status_codes
 import pandas as pd
 
 class VehicleRepository(object):
     vehicles = {}
+    fleet = FleetStore()
+    changed_ids = set()     # Vehicles whose row may differ from the last frame popped them, see pop_changed_ids
 
     @classmethod
     def init(cls):
         cls.vehicles = {}
+        cls.fleet = FleetStore()
+        cls.changed_ids = set()
 
     @classmethod
     def populate(cls, vehicle_id, location, type):
-        state = VehicleState(vehicle_id, location, type)
+        state = VehicleState(vehicle_id, location, type, cls.fleet)
         cls.vehicles[vehicle_id] = Vehicle(state)
 
     @classmethod
@@ -24,18 +31,38 @@ class VehicleRepository(object):
 
     @classmethod
     def get_states(cls):
-        states = [vehicle.get_state() for vehicle in cls.get_all()]
-        cols = VehicleState.__slots__[:]
-        df = pd.DataFrame.from_records(states, columns=cols).set_index("id")    # Creating DF with all attributes in Vehicle State
-        df["earnings"] = [vehicle.earnings for vehicle in cls.get_all()]
-        df["pickup_time"] = [vehicle.pickup_time for vehicle in cls.get_all()]
-        df["cost"] = [vehicle.compute_fuel_consumption() for vehicle in cls.get_all()]
-        df["total_idle"] = [vehicle.get_idle_duration() for vehicle in cls.get_all()]
+        # Static columns are read-only views of the fleet store; the others are copied, as the simulator updates
+        # them while the frame is in use (match_vehicles, dispatch_vehicles) and Central_Agent.update_vehicles
+        # writes status. The frame is valid until the next step releases vehicles
+        states = {name: cls.fleet.readonly_view(name) if name in FleetStore.static_columns
+                  else cls.fleet.view(name).copy() for name in VehicleState.fields}
+        cls.changed_ids |= cls.fleet.pop_changed_ids()
+        index = pd.Index(states.pop("id"), name="id", copy=False)
+        df = pd.DataFrame(states, index=index, columns=VehicleState.fields[1:], copy=False)    # Creating DF with all attributes in Vehicle State
+        df["earnings"] = cls.fleet.view("earnings").copy()
+        df["pickup_time"] = cls.fleet.view("pickup_time").copy()
+        df["cost"] = (df.travel_dist.values * (df.gas_price.values / (df.mileage.values * 1000.0))) / 100.0
+        duration = cls.fleet.view("duration")
+        df["total_idle"] = cls.fleet.view("working_time") - duration[:, status_codes.V_OCCUPIED] \
+                           - duration[:, status_codes.V_ASSIGNED]
         # df["agent_type"] = [vehicle.get_idle_duration() for vehicle in cls.get_all()]
         # print(df.columns.names)
         return df
 
 
+    # Vehicles whose matching state (location, status, availability) changed between the frames of the previous
+    # call and of the last get_states, including the ones that left the fleet
+    @classmethod
+    def pop_changed_ids(cls):
+        changed_ids, cls.changed_ids = cls.changed_ids, set()
+        return changed_ids
+
+    @classmethod
+    # Step every vehicle at once, returns the vehicles leaving the market
+    def step_all(cls, timestep):
+        return step_fleet(cls.fleet, cls.vehicles, timestep)
+
     @classmethod
     def delete(cls, vehicle_id):
-        cls.vehicles.pop(vehicle_id)
+        vehicle = cls.vehicles.pop(vehicle_id)
+        cls.fleet.release(vehicle.state.row)
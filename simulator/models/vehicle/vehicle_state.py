@@ -1,15 +1,22 @@
 from novelties import status_codes
 from novelties import vehicle_types, agent_codes
 from random import randrange
+import numpy as np
+from .fleet_store import FleetStore
 
 class VehicleState(object):
-    # State Vector for the vehicle
-    __slots__ = [
+    # State Vector for the vehicle, the values live in one row of a FleetStore
+    fields = [
         'id', 'lat', 'lon', 'speed', 'status', 'destination_lat', 'destination_lon', 'type', 'travel_dist', 'price_per_travel_m', 'price_per_wait_min', 'gas_price',
         'assigned_customer_id', 'time_to_destination', 'idle_duration', 'current_capacity', 'max_capacity', 'driver_base_per_trip', 'mileage', 'agent_type']
+    __slots__ = ['_store', '_row']
 
 
-    def __init__(self, id, location, agent_type):
+    def __init__(self, id, location, agent_type, store=None):
+        if store is None:
+            store = FleetStore(capacity=1)
+        self._store = store
+        self._row = store.allocate(self)
         self.id = id
         self.lat, self.lon = location
         self.speed = 0
@@ -95,7 +102,43 @@ class VehicleState(object):
 
 
     def to_msg(self):
-        state = [str(getattr(self, name)).format(":.2f") for name in self.__slots__]
+        state = [str(getattr(self, name)).format(":.2f") for name in self.fields]
         return ','.join(state)
 
-    # def
\ No newline at end of file
+    # Called by the FleetStore when the row of this vehicle moves
+    def bind(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def row(self):
+        return self._row
+
+    # def
+
+
+def _column_property(name):
+    if name == 'assigned_customer_id':
+        def fget(self):
+            value = self._store.columns[name][self._row]
+            return None if np.isnan(value) else int(value)
+    elif name in FleetStore.nullable_columns:
+        def fget(self):
+            value = self._store.columns[name][self._row]
+            return None if np.isnan(value) else value
+    else:
+        def fget(self):
+            return self._store.columns[name][self._row]
+
+    def fset(self, value):
+        self._store.set(name, self._row, np.nan if value is None else value)
+
+    return property(fget, fset)
+
+
+for _name in VehicleState.fields:
+    setattr(VehicleState, _name, _column_property(_name))
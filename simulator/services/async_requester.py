@@ -1,34 +1,47 @@
 """Asynchronous request module"""
 from concurrent import futures
-import itertools
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 class AsyncRequester(object):
     """Send asynchronous requests to list of urls
     Response time may be limited by rate of system/NW"""
-    def __init__(self, n_threads):
+    def __init__(self, n_threads, timeout=(3.05, 30), max_retries=3, backoff_factor=0.3):
         # self.urllist = []
         self.n_threads = n_threads
         self.executor = futures.ThreadPoolExecutor(max_workers=self.n_threads)
+        self.timeout = timeout      # (connect, read) seconds
+        self.session = self.create_session(max_retries, backoff_factor)
+
+    def create_session(self, max_retries, backoff_factor):
+        """Session keeping a connection alive per thread and host, retrying failed connections and
+        overloaded server responses with exponential backoff"""
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor,
+                      status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        # pool_connections is the number of hosts with a pool, pool_maxsize the connections kept per host
+        adapter = HTTPAdapter(pool_maxsize=max(self.n_threads, 1), max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
     def send_async_requests(self, urllist):
-        """Sends asynchronous requests"""
+        """Sends asynchronous requests, at most n_threads at a time"""
         if len(urllist) == 1:
             return self.get_batch(urllist)
-        # Num of batches per thread
-        n_batches = int(len(urllist) / self.n_threads) + 1
-        # List of URLs per batch
-        batch_urllist = [urllist[i * n_batches : (i + 1) * n_batches]
-                        for i in range(self.n_threads)]
-        # List of HTTP response
-        responses = list(self.executor.map(self.get_batch, batch_urllist))
-        return list(itertools.chain(*responses))    # Return 1 sequence of responses
+        # List of HTTP response, in the order of urllist
+        return list(self.executor.map(self.get_json, urllist))
 
-    def get_json(cls, url):
+    def get_json(self, url):
         """open URL and return JSON contents"""
-        result = requests.get(url).json()
+        result = self.session.get(url, timeout=self.timeout).json()
         return result
 
     def get_batch(self, urllist):
         """Batch processing for get method; takes list of urls as input"""
         return [self.get_json(url) for url in urllist]
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
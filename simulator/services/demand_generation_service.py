@@ -1,5 +1,8 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
 from simulator.models.customer.customer import Customer
-from db import Session
+from db import Session, engine
 # import request
 
 query = """
@@ -10,27 +13,59 @@ query = """
 
 
 class DemandGenerator(object):
-    def __init__(self, use_pattern=False):
+    def __init__(self, use_pattern=False, preload=False, preload_span=3600 * 24):
         if use_pattern:
             self.table = "request_pattern"
         else:
             self.table = "request_backlog"
+        # Preload mode: requests are read once per preload_span and kept as columns sorted by request time
+        self.preload = preload
+        self.preload_span = preload_span
+        self.loaded_from, self.loaded_to = None, None
+        self.request_times = None
+        self.columns = []
+        self.Request = None
 
 
     def generate(self, current_time, timestep):
+        return self.create_customers(self.fetch_requests(current_time, timestep))
+
+    # List of customers associated with each request
+    def create_customers(self, requests):
+        return [Customer(request) for request in requests]
+
+    # List of requests within a certain timeframe
+    def fetch_requests(self, current_time, timestep):
+        if self.preload:
+            return self.fetch_from_backlog(current_time, timestep)
         try:
-            # List of requests within a certain timeframe
             requests = list(Session.execute(query.format(table=self.table, t1=current_time, t2=current_time + timestep)))
-            # List of customers associated with each request
-            customers = [Customer(request) for request in requests]
             # for r in requests:
             #     print("Iterating R: ", r)
-            # print("Cust: ", len(customers), requests)
         except:
             Session.rollback()
             raise
         finally:
             Session.remove()
-        return customers
+        return requests
+
+    def fetch_from_backlog(self, current_time, timestep):
+        t1, t2 = current_time, current_time + timestep
+        if self.request_times is None or t1 < self.loaded_from or t2 > self.loaded_to:
+            self.load_backlog(t1, t1 + max(self.preload_span, timestep))
+        start, end = np.searchsorted(self.request_times, [t1, t2])
+        return self.get_requests(start, end)
 
+    # Load the requests within [t1, t2) into columns sorted by request time
+    def load_backlog(self, t1, t2):
+        df = pd.read_sql(query.format(table=self.table, t1=t1, t2=t2), engine)
+        df = df.sort_values("request_datetime", kind="mergesort")
+        self.Request = namedtuple("Request", df.columns, rename=True)
+        self.columns = [df[column].values for column in df.columns]
+        self.request_times = df["request_datetime"].values
+        self.loaded_from, self.loaded_to = t1, t2
 
+    # Row records of the loaded requests from start to end, with the same fields as the query rows
+    def get_requests(self, start, end):
+        values = [column[start:end].tolist() for column in self.columns]
+        return [self.Request._make(row) for row in zip(*values)]
@@ -0,0 +1,81 @@
+"""Persistent cache of OSRM results, kept in an SQLite file across runs"""
+import hashlib
+import pickle
+import sqlite3
+
+MAX_VARIABLES = 500     # Keys per statement, below SQLite's limit on bound variables
+
+
+class OSRMCache(object):
+    """Maps keys (any repr-able tuple) to picklable values in one table of the file, evicting the least recently
+    used entries once there are more than max_entries. Several caches and processes may share the file."""
+    def __init__(self, path, max_entries, table="cache"):
+        self.max_entries = max_entries
+        self.table = table
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value BLOB, last_used INTEGER)"
+                                .format(table))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS {0}_last_used ON {0} (last_used)".format(table))
+        self.connection.commit()
+        self.n_entries, self.clock = self.connection.execute(
+            "SELECT COUNT(*), MAX(last_used) FROM {}".format(table)).fetchone()
+        self.clock = self.clock or 0
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    @staticmethod
+    def chunks(hashes):
+        for i in range(0, len(hashes), MAX_VARIABLES):
+            chunk = hashes[i:i + MAX_VARIABLES]
+            yield chunk, ",".join("?" * len(chunk))
+
+    def get_many(self, keys):
+        """Cached values of keys, None for the missing ones"""
+        hashes = [self.hash_key(key) for key in keys]
+        found = {}
+        with self.connection:
+            clock = self.tick()
+            for chunk, marks in self.chunks(list(set(hashes))):
+                found.update(self.connection.execute(
+                    "SELECT key, value FROM {} WHERE key IN ({})".format(self.table, marks), chunk))
+                self.connection.execute("UPDATE {} SET last_used = ? WHERE key IN ({})".format(self.table, marks),
+                                        [clock] + chunk)
+        return [pickle.loads(found[h]) if h in found else None for h in hashes]
+
+    def put_many(self, items):
+        values = {self.hash_key(key): pickle.dumps(value) for key, value in items}
+        hashes = list(values)
+        with self.connection:
+            clock = self.tick()
+            n_existing = 0
+            for chunk, marks in self.chunks(hashes):
+                n_existing += self.connection.execute(
+                    "SELECT COUNT(*) FROM {} WHERE key IN ({})".format(self.table, marks), chunk).fetchone()[0]
+            self.connection.executemany(
+                "INSERT INTO {} (key, value, last_used) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, last_used = excluded.last_used"
+                .format(self.table), [(h, values[h], clock) for h in hashes])
+        self.n_entries += len(hashes) - n_existing
+        if self.n_entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        with self.connection:
+            # Other processes may have added entries too
+            self.n_entries = self.connection.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+            n_evicted = self.n_entries - self.max_entries
+            if n_evicted > 0:
+                self.connection.execute("DELETE FROM {0} WHERE key IN "
+                                        "(SELECT key FROM {0} ORDER BY last_used LIMIT ?)".format(self.table),
+                                        (n_evicted,))
+                self.n_entries -= n_evicted
+
+    def close(self):
+        self.connection.close()
@@ -1,15 +1,93 @@
 """Modified RoutingService.route to accept od_pairs list and make asynchronous requests to it"""
 
+from collections import defaultdict
+import numpy as np
 import polyline
 from .async_requester import AsyncRequester
+from .osrm_cache import OSRMCache
 from config.settings import OSRM_HOSTPORT
+from common import geoutils
 from common.mesh import convert_xy_to_lonlat
 
+
+def latlon_key(latlon):
+    return tuple(float(v) for v in latlon)
+
+
 class OSRMEngine(object):
     """Sends and parses asynchronous requests from list of O-D pairs"""
-    def __init__(self, n_threads=8):
+    def __init__(self, n_threads=8, cache_path=None, cache_size=1000000):
         self.async_requester = AsyncRequester(n_threads)
         self.route_cache = {}
+        # Routes persisted across runs, keyed by the exact coordinates of the request, and ETAs of each
+        # (origin, destination) pair, in a table of their own so that they do not evict the routes
+        self.cache = OSRMCache(cache_path, cache_size, table="routes") if cache_path else None
+        self.eta_cache = OSRMCache(cache_path, cache_size, table="etas") if cache_path else None
+
+    def send_cached_requests(self, keys, urllist, parse):
+        """Returns parse(response) for each url, reading and storing the results in the persistent cache
+        under their keys if there is one. None results are not cached."""
+        if self.cache is None:
+            return [parse(res) for res in self.async_requester.send_async_requests(urllist)]
+        results = self.cache.get_many(keys)
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            responses = self.async_requester.send_async_requests([urllist[i] for i in misses])
+            for i, res in zip(misses, responses):
+                results[i] = parse(res)
+            self.cache.put_many([(keys[i], results[i]) for i in misses if results[i] is not None])
+        return results
+
+    def send_eta_requests(self, pair_keys, urllist, parse):
+        """Returns parse(response) for each url: the durations of its (origin, destination) pairs, in the order
+        of pair_keys. Durations are cached per pair, and a url is only requested if some of its pairs are not
+        cached. Pairs without a route are not cached."""
+        if self.eta_cache is None:
+            return [parse(res) for res in self.async_requester.send_async_requests(urllist)]
+        cached = self.eta_cache.get_many([key for keys in pair_keys for key in keys])
+        results = []
+        misses = []
+        offset = 0
+        for i, keys in enumerate(pair_keys):
+            durations = cached[offset:offset + len(keys)]
+            offset += len(keys)
+            if any(d is None for d in durations):
+                misses.append(i)
+                durations = None
+            results.append(durations)
+        if misses:
+            responses = self.async_requester.send_async_requests([urllist[i] for i in misses])
+            items = []
+            for i, res in zip(misses, responses):
+                results[i] = parse(res)
+                items.extend((key, d) for key, d in zip(pair_keys[i], results[i]) if d is not None)
+            self.eta_cache.put_many(items)
+        return results
+
+    def eta_pairs(self, pair_keys):
+        """Durations of the (origin, destination) pairs: cached ones are read from the cache, the others are
+        requested with one table request per origin for its missing destinations only, and cached.
+        Pairs without a route have a None duration and are not cached."""
+        if self.eta_cache is None:
+            durations = [None] * len(pair_keys)
+        else:
+            durations = self.eta_cache.get_many(pair_keys)
+        misses = defaultdict(list)
+        for i, (key, t) in enumerate(zip(pair_keys, durations)):
+            if t is None:
+                misses[key[0]].append(i)
+        if misses:
+            urllist = [self.get_eta_one_to_many_url([origin] + [pair_keys[i][1] for i in idx])
+                       for origin, idx in misses.items()]
+            items = []
+            for idx, res in zip(misses.values(), self.async_requester.send_async_requests(urllist)):
+                for i, t in zip(idx, res["durations"][0][1:]):
+                    durations[i] = t
+                    if t is not None:
+                        items.append((pair_keys[i], t))
+            if self.eta_cache is not None:
+                self.eta_cache.put_many(items)
+        return durations
 
     def nearest_road(self, points):
         """Input list of Origin-Destination (lat,lon) pairs, return
@@ -32,20 +110,21 @@ class OSRMEngine(object):
         """Input list of Origin-Destination latlong pairs, return
         tuple of (trajectory latlongs, distance, triptime)"""
         urllist = [self.get_route_url(origin, destin) for origin, destin in od_list]
-        responses = self.async_requester.send_async_requests(urllist)
-        resultlist = []
-        for res in responses:
+        keys = [(latlon_key(origin), latlon_key(destin), decode) for origin, destin in od_list]
+
+        def parse(res):
             if "routes" not in res:
-                continue
+                return None
             route = res["routes"][0]    # Getting the next route available
             triptime = route["duration"]
             if decode:
                 trajectory = polyline.decode(route['geometry'])
             else:
                 trajectory = route['geometry']
-            resultlist.append((trajectory, triptime))
+            return trajectory, triptime
 
-        return resultlist
+        results = self.send_cached_requests(keys, urllist, parse)
+        return [result for result in results if result is not None]
 
     # Getting trajectory, time from cache if exists, and storing it to the cache if it does not exsist
     def get_route_cache(self, l, a):
@@ -66,32 +145,32 @@ class OSRMEngine(object):
     # Estimating Duration
     def eta_one_to_many(self, origin_destins_list):
         urllist = [self.get_eta_one_to_many_url([origin] + destins) for origin, destins in origin_destins_list]
-        responses = self.async_requester.send_async_requests(urllist)
-        resultlist = []
-        for res in responses:
-            eta_list = res["durations"][0][1:]
-            resultlist.append(eta_list)
-        return resultlist
+        pair_keys = [[(latlon_key(origin), latlon_key(destin)) for destin in destins]
+                     for origin, destins in origin_destins_list]
+        return self.send_eta_requests(pair_keys, urllist, lambda res: res["durations"][0][1:])
 
     def eta_many_to_one(self, origins_destin_list):
         urllist = [self.get_eta_one_to_many_url(origins + [destin]) for origins, destin in origins_destin_list]
-        responses = self.async_requester.send_async_requests(urllist)
-        resultlist = []
-        for res in responses:
-            eta_list = [d[0] for d in res["durations"][:-1]]
-            resultlist.append(eta_list)
-        return resultlist
-
-    def eta_many_to_many(self, origins, destins):
-        url = self.get_eta_many_to_many_url(origins, destins)
-        res = self.async_requester.send_async_requests([url])[0]
-        try:
-            eta_matrix = res["durations"]
-        except:
-            print(origins, destins, res)
-            raise
-        return eta_matrix
-
+        pair_keys = [[(latlon_key(origin), latlon_key(destin)) for origin in origins]
+                     for origins, destin in origins_destin_list]
+        return self.send_eta_requests(pair_keys, urllist, lambda res: [d[0] for d in res["durations"][:-1]])
+
+    def eta_many_to_many(self, origins, destins, max_distance=5000, sparse=False):
+        """Same interface as FastRoutingEngine.eta_many_to_many: only the pairs closer than max_distance (great circle)
+        are looked up, see eta_pairs. Pairs without a route have a nan duration."""
+        origins = np.array(origins, dtype=np.float64).reshape(-1, 2)
+        destins = np.array(destins, dtype=np.float64).reshape(-1, 2)
+        d = geoutils.great_circle_distance(origins[:, 0, None], origins[:, 1, None], destins[:, 0], destins[:, 1])
+        rows, cols = np.nonzero(d < max_distance)
+        pair_keys = [(latlon_key(origins[i]), latlon_key(destins[j])) for i, j in zip(rows, cols)]
+        pair_T = np.array([np.nan if t is None else t for t in self.eta_pairs(pair_keys)], dtype=np.float64)
+        pair_d = d[rows, cols]
+        if sparse:
+            return rows, cols, pair_T, pair_d
+
+        T = np.full((len(origins), len(destins)), np.inf)
+        T[rows, cols] = pair_T
+        return [T, d]
 
     def get_route_url(cls, from_latlon, to_latlon):
         """Get URL for osrm backend call for arbitrary to/from latlong pairs"""
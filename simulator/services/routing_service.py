@@ -1,8 +1,8 @@
 import os
 import pickle
 import numpy as np
-from config.settings import DATA_DIR
-from common import mesh, geoutils
+from config.settings import DATA_DIR, MIN_LAT, MIN_LON, DELTA_LAT, DELTA_LON, MAP_WIDTH, MAP_HEIGHT
+from common import mesh, geoutils, table_cache
 from .osrm_engine import OSRMEngine
 from simulator.settings import FLAGS, MAX_MOVE
 import polyline
@@ -14,7 +14,8 @@ class RoutingEngine(object):
     def create_engine(cls):
         if cls.engine is None:
             if FLAGS.use_osrm:
-                cls.engine = OSRMEngine()
+                cache_path = os.path.join(DATA_DIR, 'osrm_cache.sqlite3') if FLAGS.osrm_cache > 0 else None
+                cls.engine = OSRMEngine(cache_path=cache_path, cache_size=FLAGS.osrm_cache)
             else:
                 cls.engine = FastRoutingEngine()
         return cls.engine
@@ -23,22 +24,34 @@ class RoutingEngine(object):
 class FastRoutingEngine(object):
     def __init__(self):
         self.tt_map = np.load(os.path.join(DATA_DIR, 'tt_map.npy'))
-        self.routes = pickle.load(open(os.path.join(DATA_DIR, 'routes.pkl'), 'rb'))
+        self.route_coords, self.route_index, self.routes = None, None, None
+        coords_path = os.path.join(DATA_DIR, 'route_coords.npy')
+        index_path = os.path.join(DATA_DIR, 'route_index.npy')
+        if os.path.exists(coords_path) and os.path.exists(index_path):
+            # Binary store from preprocessing/create_tt_map.py, shared read-only between processes
+            self.route_coords = np.load(coords_path, mmap_mode='r')
+            self.route_index = np.load(index_path, mmap_mode='r')
+        else:
+            self.routes = pickle.load(open(os.path.join(DATA_DIR, 'routes.pkl'), 'rb'))
 
-        d = self.tt_map.copy()
-        for x in range(d.shape[0]):
-            origin_lon = mesh.X2lon(x)
-            for y in range(d.shape[1]):
-                origin_lat = mesh.Y2lat(y)
-                for axi in range(d.shape[2]):
-                    x_ = x + axi - MAX_MOVE
-                    destin_lon = mesh.X2lon(x_)
-                    for ayi in range(d.shape[3]):
-                        y_ = y + ayi - MAX_MOVE
-                        destin_lat = mesh.Y2lat(y_)
-                        d[x, y, axi, ayi] = geoutils.great_circle_distance(
-                            origin_lat, origin_lon, destin_lat, destin_lon)
-        self.ref_d = d  # Distance in meters
+        if FLAGS.cache_tables:
+            key = table_cache.make_key(MIN_LAT, MIN_LON, DELTA_LAT, DELTA_LON, MAP_WIDTH, MAP_HEIGHT, MAX_MOVE,
+                                       self.tt_map.shape, self.tt_map.dtype.str)
+            self.ref_d = table_cache.load_or_build(os.path.join(DATA_DIR, 'ref_d_{}.npy'.format(key)),
+                                                   self.build_reference_distance)
+        else:
+            self.ref_d = self.build_reference_distance()  # Distance in meters
+
+    # Distance between each cell center and the center of each cell reachable by an action
+    def build_reference_distance(self):
+        W, H, AX, AY = self.tt_map.shape
+        x, y = np.arange(W), np.arange(H)
+        origin_lon, origin_lat = mesh.X2lon(x), mesh.Y2lat(y)
+        destin_lon = mesh.X2lon(x[:, None] + np.arange(AX) - MAX_MOVE)     # (x, axi)
+        destin_lat = mesh.Y2lat(y[:, None] + np.arange(AY) - MAX_MOVE)     # (y, ayi)
+        d = geoutils.great_circle_distance(origin_lat[None, :, None, None], origin_lon[:, None, None, None],
+                                           destin_lat[None, :, None, :], destin_lon[:, None, :, None])
+        return d.astype(self.tt_map.dtype)
 
     # (Origin - destination) pairs
     def route(self, od_pairs):
@@ -49,32 +62,53 @@ class FastRoutingEngine(object):
             ax, ay = x_ - x, y_ - y
             axi = x_ - x + MAX_MOVE
             ayi = y_ - y + MAX_MOVE
-            trajectory = polyline.decode(self.routes[(x, y)][(ax, ay)]) # Route from origin to destination
+            if self.route_coords is not None:
+                offset, length = self.route_index[x, y, axi, ayi]
+                if length == 0:     # Pairs missing from the store are left at (0, 0)
+                    raise KeyError(self.missing_route(x, y, ax, ay))
+                trajectory = self.route_coords[offset : offset + length]   # Route from origin to destination, (lat, lon) rows
+            else:
+                geometry = self.routes.get((x, y), {}).get((ax, ay))
+                if geometry is None:
+                    raise KeyError(self.missing_route(x, y, ax, ay))
+                trajectory = polyline.decode(geometry) # Route from origin to destination
             triptime = self.tt_map[x, y, axi, ayi]
             results.append((trajectory, triptime))
         return results
 
+    @staticmethod
+    def missing_route(x, y, ax, ay):
+        return "No route from location {} for action {}, rebuild the routes with preprocessing/create_tt_map.py"\
+            .format((int(x), int(y)), (int(ax), int(ay)))
+
     # Estimating arrival (Duration) continously until we reach destination
-    def eta_many_to_many(self, origins, destins, max_distance=5000, ref_speed=5.0):
-        T = np.full((len(origins), len(destins)), np.inf)
-        origins_lat, origins_lon = zip(*origins)
-        destins_lat, destins_lon = zip(*destins)
-        origins_lat, origins_lon, destins_lat, destins_lon = map(np.array, [origins_lat, origins_lon, destins_lat, destins_lon])
+    # With sparse=True, returns (rows, cols, T, d) for the finite pairs only instead of the dense matrices
+    def eta_many_to_many(self, origins, destins, max_distance=5000, ref_speed=5.0, sparse=False):
+        origins_lat, origins_lon = np.array(origins, dtype=np.float64).reshape(-1, 2).T
+        destins_lat, destins_lon = np.array(destins, dtype=np.float64).reshape(-1, 2).T
         origins_x, origins_y = mesh.lon2X(origins_lon), mesh.lat2Y(origins_lat)
         destins_x, destins_y = mesh.lon2X(destins_lon), mesh.lat2Y(destins_lat)
         d = geoutils.great_circle_distance(origins_lat[:, None], origins_lon[:, None],
                                            destins_lat, destins_lon)
 
-        for i, (x, y) in enumerate(zip(origins_x, origins_y)):
-            for j in np.where(d[i] < max_distance)[0]:
-                axi = destins_x[j] - x + MAX_MOVE
-                ayi = destins_y[j] - y + MAX_MOVE
-                if 0 <= axi and axi <= 2 * MAX_MOVE and 0 <= ayi and ayi <= 2 * MAX_MOVE:
-                    ref_d = self.ref_d[x, y, axi, ayi]
-                    if ref_d == 0:
-                        T[i, j] = d[i, j] / ref_speed
-                    else:
-                        T[i, j] = self.tt_map[x, y, axi, ayi] * d[i, j] / ref_d
+        rows, cols = np.nonzero(d < max_distance)
+        x, y = origins_x[rows], origins_y[rows]
+        axi = destins_x[cols] - x + MAX_MOVE
+        ayi = destins_y[cols] - y + MAX_MOVE
+        in_range = (axi >= 0) & (axi <= 2 * MAX_MOVE) & (ayi >= 0) & (ayi <= 2 * MAX_MOVE)
+        rows, cols, x, y, axi, ayi = rows[in_range], cols[in_range], x[in_range], y[in_range], axi[in_range], ayi[in_range]
+
+        ref_d = self.ref_d[x, y, axi, ayi]
+        pair_d = d[rows, cols]
+        no_ref = ref_d == 0
+        pair_T = np.empty(len(rows))
+        pair_T[no_ref] = pair_d[no_ref] / ref_speed
+        pair_T[~no_ref] = self.tt_map[x, y, axi, ayi][~no_ref] * pair_d[~no_ref] / ref_d[~no_ref]
+        if sparse:
+            return rows, cols, pair_T, pair_d
+
+        T = np.full((len(origins), len(destins)), np.inf)
+        T[rows, cols] = pair_T
         return [T, d]
 
 
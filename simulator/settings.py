@@ -38,8 +38,16 @@ flags.DEFINE_integer('batch_size', 128, "number of samples in a batch for SGD")
 flags.DEFINE_string('tag', 'test', "tag used to identify logs")
 flags.DEFINE_boolean('log_vehicle', False, "whether to log vehicle states")
 flags.DEFINE_boolean('use_osrm', False, "whether to use OSRM")
+flags.DEFINE_integer('osrm_cache', 0, "max number of OSRM routes and ETAs kept in DATA_DIR/osrm_cache.sqlite3 across runs (0 to disable)")
 flags.DEFINE_boolean('average', False, "whether to use diffusion filter or average filter")
 flags.DEFINE_boolean('trip_diffusion', False, "whether to use trip diffusion")
+flags.DEFINE_boolean('batch_step', False, "whether to step all vehicles at once with array operations")
+flags.DEFINE_boolean('cache_tables', False, "whether to cache precomputed lookup tables under DATA_DIR")
+flags.DEFINE_string('matching', 'greedy', "matching policy: greedy or optimal")
+flags.DEFINE_integer('matching_workers', 0, "number of processes matching independent cells with pooling (0 to match in the simulator process)")
+flags.DEFINE_boolean('preload_demand', False, "whether to load the request backlog once per day instead of querying every step")
+flags.DEFINE_integer('prefetch_demand', 0, "number of steps of demand read ahead on a background thread (0 to disable)")
+flags.DEFINE_integer('actors', 0, "number of simulator processes collecting experience for a separate learner (0 to train in the simulator loop)")
 
 GAMMA = 0.98    # Discount Factor
 MAX_MOVE = 7
@@ -63,9 +71,13 @@ INITIAL_EPSILON = 1.0  # Initial value of epsilon in epsilon-greedy
 FINAL_EPSILON = 0.01  # Final value of epsilon in epsilon-greedy
 INITIAL_MEMORY_SIZE = 100  # Number of steps to populate the replay memory before training starts
 NUM_SUPPLY_DEMAND_HISTORY = 7 * 24 * 3600 / GLOBAL_STATE_UPDATE_CYCLE + 1 # = 1 week
+# Expanded supply demand snapshots cached between replays (~300 KB each). Two per transition of a batch covers the
+# reuse within a batch; NUM_SUPPLY_DEMAND_HISTORY keeps every snapshot expanded
+SUPPLY_DEMAND_CACHE_SIZE = 2 * FLAGS.batch_size
 MAX_MEMORY_SIZE = 10000000  # Number of replay memory the dummy_agent uses for training
 SAVE_INTERVAL = 1000  # The frequency with which the network is saved
 TARGET_UPDATE_INTERVAL = 50  # The frequency with which the target network is updated
+ACTOR_UPDATE_INTERVAL = 10  # The frequency with which the learner sends its network weights to the actors
 LEARNING_RATE = 0.00025  # Learning rate used by RMSProp
 MOMENTUM = 0.95  # Momentum used by RMSProp
 MIN_GRAD = 0.01  # Constant added to the squared gradient in the denominator of the RMSProp update
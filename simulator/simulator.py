@@ -3,6 +3,7 @@ from simulator.models.vehicle.vehicle_repository import VehicleRepository
 from simulator.models.customer.customer_repository import CustomerRepository
 from simulator.services.demand_generation_service import DemandGenerator
 from simulator.services.routing_service import RoutingEngine
+from common.prefetcher import Prefetcher
 from common.time_utils import get_local_datetime
 from config.settings import OFF_DURATION, PICKUP_DURATION
 from simulator.settings import FLAGS
@@ -17,7 +18,8 @@ class Simulator(object):
         self.reset(start_time, timestep)
         sim_logger.setup_logging(self)
         self.logger = getLogger(__name__)
-        self.demand_generator = DemandGenerator()
+        self.demand_generator = DemandGenerator(preload=FLAGS.preload_demand)
+        self.request_prefetcher = None
         self.routing_engine = RoutingEngine.create_engine()
         self.route_cache = {}
         self.current_dummyV = 0
@@ -56,17 +58,15 @@ class Simulator(object):
             if customer.is_arrived() or customer.is_disappeared():
                 CustomerRepository.delete(customer.get_id())
 
-        for vehicle in VehicleRepository.get_all():
-            vehicle.step(self.__dt)
-            # vehicle.print_vehicle()
-            if vehicle.exit_market():
-                score = ','.join(map(str, [self.get_current_time(), vehicle.get_id()] + vehicle.get_score()))
-                if vehicle.agent_type == agent_codes.dqn_agent:
-                    self.current_dqnV -= 1
-                else:
-                    self.current_dummyV -= 1
-                sim_logger.log_score(score)
-                VehicleRepository.delete(vehicle.get_id())
+        if FLAGS.batch_step:
+            for vehicle in VehicleRepository.step_all(self.__dt):
+                self.__exit_market(vehicle)
+        else:
+            for vehicle in VehicleRepository.get_all():
+                vehicle.step(self.__dt)
+                # vehicle.print_vehicle()
+                if vehicle.exit_market():
+                    self.__exit_market(vehicle)
 
         self.__populate_new_customers()
         self.__update_time()
@@ -74,6 +74,15 @@ class Simulator(object):
             # print("Elapsed : {}".format(get_local_datetime(self.__t)))
             self.logger.info("Elapsed : {}".format(get_local_datetime(self.__t)))
 
+    def __exit_market(self, vehicle):
+        score = ','.join(map(str, [self.get_current_time(), vehicle.get_id()] + vehicle.get_score()))
+        if vehicle.agent_type == agent_codes.dqn_agent:
+            self.current_dqnV -= 1
+        else:
+            self.current_dummyV -= 1
+        sim_logger.log_score(score)
+        VehicleRepository.delete(vehicle.get_id())
+
     def match_vehicles(self, commands, dqn_agent, dummy_agent):
         # print("M: ", commands)
         vehicle_list = []
@@ -183,9 +192,24 @@ class Simulator(object):
         self.__t += self.__dt
 
     def __populate_new_customers(self):
-        new_customers = self.demand_generator.generate(self.__t, self.__dt)
+        if self.request_prefetcher is not None:
+            requests = self.request_prefetcher.get(self.__t)
+            new_customers = self.demand_generator.create_customers(requests)
+        else:
+            new_customers = self.demand_generator.generate(self.__t, self.__dt)
         CustomerRepository.update_customers(new_customers)
 
+    # Read the requests of the coming steps until end_time on a background thread
+    def start_prefetch(self, end_time, depth):
+        dt = self.__dt
+        self.request_prefetcher = Prefetcher(lambda t: self.demand_generator.fetch_requests(t, dt),
+                                             range(self.__t, end_time, dt), depth)
+
+    def stop_prefetch(self):
+        if self.request_prefetcher is not None:
+            self.request_prefetcher.stop()
+            self.request_prefetcher = None
+
     def sample_off_duration(self):
         return np.random.randint(OFF_DURATION / 2, OFF_DURATION * 3 / 2)
 
@@ -2,6 +2,8 @@ import sys
 sys.path.insert(0, 'C:/Users/17657/Desktop/RideSharing_Pricing')
 
 import os
+import random
+import multiprocessing
 import pandas as pd
 import numpy as np
 from common.time_utils import get_local_datetime
@@ -16,7 +18,8 @@ import simulator.simulator as sim
 from simulator.models.vehicle.vehicle_repository import VehicleRepository
 from novelties import agent_codes
 from dqn_agent.dqn_policy import DQNDispatchPolicy, DQNDispatchPolicyLearner
-from config.settings import TIMESTEP, MAP_WIDTH, MAP_HEIGHT, ENTERING_TIME_BUFFER,DEFAULT_LOG_DIR
+from dqn_agent.actor_learner import ActorDispatchPolicy, run_learner
+from config.settings import TIMESTEP, MAP_WIDTH, MAP_HEIGHT, ENTERING_TIME_BUFFER,DEFAULT_LOG_DIR, GLOBAL_STATE_UPDATE_CYCLE
 from datetime import datetime
 import time
 
@@ -71,6 +74,13 @@ def setup_base_log_dir(base_log_dir):
         os.unlink(DEFAULT_LOG_DIR)
     os.symlink(base_log_dir, DEFAULT_LOG_DIR)
 
+# Simulator logs of an actor process, next to ./logs/<tag>
+def setup_actor_log_dir(actor_id):
+    log_path = "./logs/{}_actor{}/sim".format(FLAGS.tag, actor_id)
+    if not os.path.exists(log_path):
+        os.makedirs(log_path)
+    return log_path
+
 class simulator_driver(object):
     # For DQN
     def __init__(self, start_time, timestep, matching_policy, dispatch_policy, pricing_policy):
@@ -111,176 +121,219 @@ class simulator_driver(object):
                 break
 
 
-if __name__ == '__main__':
+def run_simulation(dispatch_policy, start_time):
+    # print(start_time, MAX_DISPATCH_CYCLE, MIN_DISPATCH_CYCLE)
+    print("Start Datetime: {}".format(get_local_datetime(start_time)))
+    end_time = start_time + int(60 * 60 * 24 * FLAGS.days)
+    print("End Datetime  : {}".format(get_local_datetime(end_time)))
 
-    start = time.time()
     # For DQN
-    dispatch_policy = load()
-    # setup_base_log_dir(FLAGS.tag)
-    if FLAGS.days > 0:
-        start_time = FLAGS.start_time + int(60 * 60 * 24 * FLAGS.start_offset)
-        # print(start_time, MAX_DISPATCH_CYCLE, MIN_DISPATCH_CYCLE)
-        print("Start Datetime: {}".format(get_local_datetime(start_time)))
-        end_time = start_time + int(60 * 60 * 24 * FLAGS.days)
-        print("End Datetime  : {}".format(get_local_datetime(end_time)))
+    if FLAGS.matching == "optimal":
+        matcher = matching_policy.OptimalMatchingPolicy(n_workers=FLAGS.matching_workers)
+    else:
+        matcher = matching_policy.GreedyMatchingPolicy(n_workers=FLAGS.matching_workers)
+    Sim_experiment = simulator_driver(start_time, TIMESTEP, matcher, dispatch_policy, pricing_policy.PricingPolicy())
+    # Sim_experiment = simulator_driver(start_time, TIMESTEP, matching_policy.GreedyMatchingPolicy())
+    if FLAGS.prefetch_demand > 0:
+        Sim_experiment.simulator.start_prefetch(end_time, FLAGS.prefetch_demand)
+        dispatch_policy.feature_constructor.demand_loader.start_prefetch(start_time, end_time, GLOBAL_STATE_UPDATE_CYCLE,
+                                                                         FLAGS.prefetch_demand)
+
+    # header = "TimeStamp, Unix TIme, Vehicles, Occupied Vehicles, Requests, Matchings, Rejects, Accepts, Avg Wait Time per request, Avg Earnings, " \
+    #          "Avg Cost, Avg Profit for DQN, Avg Profit for dummy, Avg Total Dist, Avg Capacity per vehicle, Avg Idle Time"
+    # sim_logger.log_summary(header)
+    # header = "TimeStamp, Request ID, Status Code, Waiting_Time"
+    # sim_logger.log_customer_event(header)
+    # header = "V_id', V_lat, V_lon, Speed, Status, Dest_lat, Dest_lon, Type, Travel_Dist, Price_per_travel_m, Price_per_wait_min, Gas_price,"\
+    # "assigned_customer_id, Time_to_destination, Idle_Duration, Total_Idle, Current_Capacity, Max_Capacity, Driver_base_per_trip, Mileage"
+    # sim_logger.log_vehicle_event(header)
+
+    n_steps = int(3600 * 24 / TIMESTEP)
+    buffer_steps = int(3600 / TIMESTEP)
+    # print(DB_HOST_PATH)
+    # n = 0
+    for _ in range(FLAGS.days):
+        vehicle_locations = Sim_experiment.sample_initial_locations(Sim_experiment.simulator.get_current_time() + 3600 * 3)
+        Sim_experiment.populate_vehicles(vehicle_locations)
+        sum_avg_cust = 0
+        # sum_avg_profit = 0
+        sum_avg_wait = 0
+        sum_requests = 0
+        sum_accepts = 0
+        sum_rejects = 0
+        prev_rejected_req = []
+        print("############################ SUMMARY ################################")
+        for i in range(n_steps):
+            Sim_experiment.enter_market()
+            Sim_experiment.simulator.step()
+            vehicles = Sim_experiment.simulator.get_vehicles_state()
+            # print("V: ", len(vehicles))
+            requests = Sim_experiment.simulator.get_new_requests()
+            col_names = requests.columns.values
+            # print("Col: ", requests.columns.values)
+            # print("R before: ", len(requests))
+            # print(len(prev_rejected_req))
+
+            if FLAGS.enable_pricing:
+                prev_df = pd.DataFrame()
+                for r in prev_rejected_req:
+                    r_df = pd.DataFrame({str(c):[float(getattr(r, c))] for c in col_names})
+                    # print("B: ", len(requests), len(r_df))
+                    requests = requests.append(r_df, ignore_index=True)
+
+            sum_requests += len(requests)
+            requests = requests.set_index("id")
+            # print("R After: ", len(requests))
+
+            current_time = Sim_experiment.simulator.get_current_time()
+
+            # For DQN
+            if FLAGS.enable_pricing:
+                # print("All: ", len(vehicles), m)
+                if len(vehicles) > 0:
+                    new_vehicles = vehicles.loc[[vehicle_id for vehicle_id in vehicles.index
+                    if VehicleRepository.get(vehicle_id).first_dispatched == 0]]
+                    startup_dispatch = Sim_experiment.dqn_agent.startup_dispatch(current_time, new_vehicles)
+                    Sim_experiment.simulator.dispatch_vehicles(startup_dispatch)
+                    # print("Done", len(new_vehicles))
+
+            if len(vehicles) == 0:
+                continue
+            else:
+                # print("V1: ", len(vehicles))
+                m_commands, vehicles = Sim_experiment.central_agent.get_match_commands(current_time, vehicles, requests)
+                # print("V2: ", len(vehicles))
 
-        # For DQN
-        Sim_experiment = simulator_driver(start_time, TIMESTEP, matching_policy.GreedyMatchingPolicy(), dispatch_policy, pricing_policy.PricingPolicy())
-        # Sim_experiment = simulator_driver(start_time, TIMESTEP, matching_policy.GreedyMatchingPolicy())
-
-        # header = "TimeStamp, Unix TIme, Vehicles, Occupied Vehicles, Requests, Matchings, Rejects, Accepts, Avg Wait Time per request, Avg Earnings, " \
-        #          "Avg Cost, Avg Profit for DQN, Avg Profit for dummy, Avg Total Dist, Avg Capacity per vehicle, Avg Idle Time"
-        # sim_logger.log_summary(header)
-        # header = "TimeStamp, Request ID, Status Code, Waiting_Time"
-        # sim_logger.log_customer_event(header)
-        # header = "V_id', V_lat, V_lon, Speed, Status, Dest_lat, Dest_lon, Type, Travel_Dist, Price_per_travel_m, Price_per_wait_min, Gas_price,"\
-        # "assigned_customer_id, Time_to_destination, Idle_Duration, Total_Idle, Current_Capacity, Max_Capacity, Driver_base_per_trip, Mileage"
-        # sim_logger.log_vehicle_event(header)
-
-        n_steps = int(3600 * 24 / TIMESTEP)
-        buffer_steps = int(3600 / TIMESTEP)
-        # print(DB_HOST_PATH)
-        # n = 0
-        for _ in range(FLAGS.days):
-            vehicle_locations = Sim_experiment.sample_initial_locations(Sim_experiment.simulator.get_current_time() + 3600 * 3)
-            Sim_experiment.populate_vehicles(vehicle_locations)
-            sum_avg_cust = 0
-            # sum_avg_profit = 0
-            sum_avg_wait = 0
-            sum_requests = 0
-            sum_accepts = 0
-            sum_rejects = 0
-            prev_rejected_req = []
-            print("############################ SUMMARY ################################")
-            for i in range(n_steps):
-                Sim_experiment.enter_market()
-                Sim_experiment.simulator.step()
-                vehicles = Sim_experiment.simulator.get_vehicles_state()
-                # print("V: ", len(vehicles))
-                requests = Sim_experiment.simulator.get_new_requests()
-                col_names = requests.columns.values
-                # print("Col: ", requests.columns.values)
-                # print("R before: ", len(requests))
-                # print(len(prev_rejected_req))
+                # V_R_matching = defaultdict(list)
+                # for command in m_commands:
+                #     V_R_matching[command["vehicle_id"]].append(CustomerRepository.get(command["customer_id"]).get_request())
 
-                if FLAGS.enable_pricing:
-                    prev_df = pd.DataFrame()
-                    for r in prev_rejected_req:
-                        r_df = pd.DataFrame({str(c):[float(getattr(r, c))] for c in col_names})
-                        # print("B: ", len(requests), len(r_df))
-                        requests = requests.append(r_df, ignore_index=True)
+                dqn_v = vehicles[vehicles.agent_type == agent_codes.dqn_agent]
+                dummy_v = vehicles[vehicles.agent_type == agent_codes.dummy_agent]
+                # print("DQN: ", len(dqn_v), " Dummy: ", len(dummy_v))
 
-                sum_requests += len(requests)
-                requests = requests.set_index("id")
-                # print("R After: ", len(requests))
+                # For DQN and Dummy
+                d1_commands = Sim_experiment.dummy_agent.get_dispatch_commands(current_time, dummy_v)
+                d2_commands = Sim_experiment.dqn_agent.get_dispatch_commands(current_time, dqn_v)
+                # print("1: ", len(d1_commands), " 2: ", len(d2_commands))
 
-                current_time = Sim_experiment.simulator.get_current_time()
+                all_commands = d1_commands + d2_commands
+                # print("A: ", len(all_commands), " 1: ", len(d1_commands), " 2: ", len(d2_commands))
 
+                prev_rejected_req, accepted_commands = Sim_experiment.simulator.match_vehicles(m_commands, Sim_experiment.dqn_agent, Sim_experiment.dummy_agent)
                 # For DQN
+                Sim_experiment.simulator.dispatch_vehicles(all_commands)
+
+
+                if (len(m_commands) == 0):
+                    print("ERR!", len(vehicles), len(requests))
+
+                avg_cap = 0
+                capacity = []
+                for index, v in vehicles.iterrows():
+                    if v.status == status_codes.V_OCCUPIED:
+                        capacity.append(v.current_capacity)
+                if len(capacity):
+                    avg_cap = np.sum(capacity) / len(capacity)
+                    sum_avg_cust += avg_cap
+                    # print(len(capacity), sum_avg_cust)
+
+                net_v = vehicles[vehicles.status != status_codes.V_OFF_DUTY]
+                occ_v = net_v[net_v.status == status_codes.V_OCCUPIED]
+
+                if len(occ_v) != len(capacity):
+                    print("Watch Occupied", len(occ_v), len(capacity))
+
                 if FLAGS.enable_pricing:
-                    # print("All: ", len(vehicles), m)
-                    if len(vehicles) > 0:
-                        new_vehicles = vehicles.loc[[vehicle_id for vehicle_id in vehicles.index
-                        if VehicleRepository.get(vehicle_id).first_dispatched == 0]]
-                        startup_dispatch = Sim_experiment.dqn_agent.startup_dispatch(current_time, new_vehicles)
-                        Sim_experiment.simulator.dispatch_vehicles(startup_dispatch)
-                        # print("Done", len(new_vehicles))
-
-                if len(vehicles) == 0:
-                    continue
-                else:
-                    # print("V1: ", len(vehicles))
-                    m_commands, vehicles = Sim_experiment.central_agent.get_match_commands(current_time, vehicles, requests)
-                    # print("V2: ", len(vehicles))
-
-                    # V_R_matching = defaultdict(list)
-                    # for command in m_commands:
-                    #     V_R_matching[command["vehicle_id"]].append(CustomerRepository.get(command["customer_id"]).get_request())
-
-                    dqn_v = vehicles[vehicles.agent_type == agent_codes.dqn_agent]
-                    dummy_v = vehicles[vehicles.agent_type == agent_codes.dummy_agent]
-                    # print("DQN: ", len(dqn_v), " Dummy: ", len(dummy_v))
-
-                    # For DQN and Dummy
-                    d1_commands = Sim_experiment.dummy_agent.get_dispatch_commands(current_time, dummy_v)
-                    d2_commands = Sim_experiment.dqn_agent.get_dispatch_commands(current_time, dqn_v)
-                    # print("1: ", len(d1_commands), " 2: ", len(d2_commands))
-
-                    all_commands = d1_commands + d2_commands
-                    # print("A: ", len(all_commands), " 1: ", len(d1_commands), " 2: ", len(d2_commands))
-
-                    prev_rejected_req, accepted_commands = Sim_experiment.simulator.match_vehicles(m_commands, Sim_experiment.dqn_agent, Sim_experiment.dummy_agent)
-                    # For DQN
-                    Sim_experiment.simulator.dispatch_vehicles(all_commands)
-
-
-                    if (len(m_commands) == 0):
-                        print("ERR!", len(vehicles), len(requests))
-
-                    avg_cap = 0
-                    capacity = []
-                    for index, v in vehicles.iterrows():
-                        if v.status == status_codes.V_OCCUPIED:
-                            capacity.append(v.current_capacity)
-                    if len(capacity):
-                        avg_cap = np.sum(capacity) / len(capacity)
-                        sum_avg_cust += avg_cap
-                        # print(len(capacity), sum_avg_cust)
-
-                    net_v = vehicles[vehicles.status != status_codes.V_OFF_DUTY]
-                    occ_v = net_v[net_v.status == status_codes.V_OCCUPIED]
-
-                    if len(occ_v) != len(capacity):
-                        print("Watch Occupied", len(occ_v), len(capacity))
-
-                    if FLAGS.enable_pricing:
-                        if len(accepted_commands) > 0:
-                            average_wt = np.mean([accepted_commands[command]['duration'] for command in accepted_commands]).astype(int)
-                        else:
-                            average_wt = 0
+                    if len(accepted_commands) > 0:
+                        average_wt = np.mean([accepted_commands[command]['duration'] for command in accepted_commands]).astype(int)
                     else:
-                        if len(m_commands) > 0:
-                            average_wt = np.mean([command['duration'] for command in m_commands]).astype(int)
-                        else:
-                            average_wt = 0
-
-                    sum_avg_wait += average_wt
-
-                    # Start time is a unix timesatmp, here we convert it to normal time
-                    readable_time = datetime.utcfromtimestamp(current_time).strftime('%Y-%m-%d %H:%M:%S')
-                    if FLAGS.enable_pricing:
-                        rejected_requests = len(requests) - len(accepted_commands)
-                        sum_accepts += len(accepted_commands)
+                        average_wt = 0
+                else:
+                    if len(m_commands) > 0:
+                        average_wt = np.mean([command['duration'] for command in m_commands]).astype(int)
                     else:
-                        rejected_requests = len(requests) - len(m_commands)
-                        sum_accepts += len(m_commands)
-                    # print("Total Rejected: ", rejected_requests)
-                    sum_rejects += rejected_requests
+                        average_wt = 0
+
+                sum_avg_wait += average_wt
+
+                # Start time is a unix timesatmp, here we convert it to normal time
+                readable_time = datetime.utcfromtimestamp(current_time).strftime('%Y-%m-%d %H:%M:%S')
+                if FLAGS.enable_pricing:
+                    rejected_requests = len(requests) - len(accepted_commands)
+                    sum_accepts += len(accepted_commands)
+                else:
+                    rejected_requests = len(requests) - len(m_commands)
+                    sum_accepts += len(m_commands)
+                # print("Total Rejected: ", rejected_requests)
+                sum_rejects += rejected_requests
+
+                avg_total_dist = np.mean(list(v.travel_dist for index, v in net_v.iterrows()))
+                avg_idle_time = np.mean(list(v.total_idle for index, v in net_v.iterrows()))
+                avg_earnings = np.mean(list(v.earnings for index, v in net_v.iterrows()))
+                avg_cost = np.mean(list(v.cost for index, v in net_v.iterrows()))
+
+                avg_profit_dqn = np.mean(list(v.earnings - v.cost for index, v in dqn_v.iterrows()))
+                avg_profit_dummy = np.mean(list(v.earnings - v.cost for index, v in dummy_v.iterrows()))
+
+                # print("P: ", avg_earnings-avg_cost, " P-DQN: ", avg_profit_dqn, " P-D: ", avg_profit_dummy)
 
-                    avg_total_dist = np.mean(list(v.travel_dist for index, v in net_v.iterrows()))
-                    avg_idle_time = np.mean(list(v.total_idle for index, v in net_v.iterrows()))
-                    avg_earnings = np.mean(list(v.earnings for index, v in net_v.iterrows()))
-                    avg_cost = np.mean(list(v.cost for index, v in net_v.iterrows()))
+                if average_wt != float(0):
+                    average_wt /= len(accepted_commands)
 
-                    avg_profit_dqn = np.mean(list(v.earnings - v.cost for index, v in dqn_v.iterrows()))
-                    avg_profit_dummy = np.mean(list(v.earnings - v.cost for index, v in dummy_v.iterrows()))
+                summary = "{:s},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f}, {:.2f}, {:.2f}".format(
+                        readable_time, current_time, len(net_v), len(net_v[net_v.status == status_codes.V_OCCUPIED]), len(requests), len(m_commands),
+                        rejected_requests, len(accepted_commands), average_wt, avg_earnings, avg_cost, avg_profit_dqn, avg_profit_dummy, avg_total_dist,
+                        avg_cap, avg_idle_time)
 
-                    # print("P: ", avg_earnings-avg_cost, " P-DQN: ", avg_profit_dqn, " P-D: ", avg_profit_dummy)
+                sim_logger.log_summary(summary)
 
-                    if average_wt != float(0):
-                        average_wt /= len(accepted_commands)
+                if FLAGS.verbose:
+                    print("summary: ({})".format(summary), flush=True)
 
-                    summary = "{:s},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f},{:.2f}, {:.2f}, {:.2f}".format(
-                            readable_time, current_time, len(net_v), len(net_v[net_v.status == status_codes.V_OCCUPIED]), len(requests), len(m_commands),
-                            rejected_requests, len(accepted_commands), average_wt, avg_earnings, avg_cost, avg_profit_dqn, avg_profit_dummy, avg_total_dist,
-                            avg_cap, avg_idle_time)
+    Sim_experiment.simulator.stop_prefetch()
+    dispatch_policy.feature_constructor.demand_loader.stop_prefetch()
+    matcher.close()
 
-                    sim_logger.log_summary(summary)
 
-                    if FLAGS.verbose:
-                        print("summary: ({})".format(summary), flush=True)
+def run_actor(actor_id, experience_queue, weight_queue):
+    np.random.seed(actor_id)
+    random.seed(actor_id)
+    sim_logger.log_dir = setup_actor_log_dir(actor_id)
+    try:
+        dispatch_policy = ActorDispatchPolicy(experience_queue, weight_queue)
+        dispatch_policy.build_q_network(load_network=FLAGS.load_network)
+        # Each actor simulates its own days, so the times of their supply demand maps don't collide
+        run_simulation(dispatch_policy, FLAGS.start_time + int(60 * 60 * 24 * (FLAGS.start_offset + actor_id * FLAGS.days)))
+    finally:
+        experience_queue.put(None)     # Tells the learner this actor is done
+
+
+# Simulators run in FLAGS.actors processes while this process trains on their experience
+def run_actor_learner(dispatch_policy):
+    ctx = multiprocessing.get_context("spawn")
+    experience_queue = ctx.Queue(maxsize=100 * FLAGS.actors)    # Actors wait when the learner falls behind
+    weight_queues = [ctx.Queue(maxsize=1) for _ in range(FLAGS.actors)]
+    actors = [ctx.Process(target=run_actor, args=(i, experience_queue, weight_queues[i]), daemon=True)
+              for i in range(FLAGS.actors)]
+    for actor in actors:
+        actor.start()
+    run_learner(dispatch_policy, experience_queue, weight_queues, FLAGS.actors)
+    for actor in actors:
+        actor.join()
+
+
+if __name__ == '__main__':
 
+    start = time.time()
+    # For DQN
+    dispatch_policy = load()
+    # setup_base_log_dir(FLAGS.tag)
+    if FLAGS.train and FLAGS.actors > 0:
+        run_actor_learner(dispatch_policy)
+    elif FLAGS.days > 0:
+        run_simulation(dispatch_policy, FLAGS.start_time + int(60 * 60 * 24 * FLAGS.start_offset))
 
     if FLAGS.train:
-        print("Dumping experience memory as pickle...")
+        print("Writing the last experience memory shard...")
         dispatch_policy.dump_experience_memory()
\ No newline at end of file
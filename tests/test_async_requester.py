@@ -0,0 +1,81 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from simulator.services.async_requester import AsyncRequester
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # Keeps connections alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.n_requests[self.path] = server.n_requests.get(self.path, 0) + 1
+            n = server.n_requests[self.path]
+        if self.path.startswith("/flaky") and n <= 2:
+            self.reply(503, {"code": "Busy"})
+        else:
+            self.reply(200, {"path": self.path})
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.n_connections = 0
+        self.n_requests = {}
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.n_connections += 1
+        super().process_request(request, client_address)
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path):
+    return "http://127.0.0.1:{}{}".format(server.server_address[1], path)
+
+
+def test_connections_are_reused(server):
+    requester = AsyncRequester(4)
+    paths = ["/route/{}".format(i) for i in range(200)]
+    try:
+        results = requester.send_async_requests([url(server, p) for p in paths])
+    finally:
+        requester.close()
+    assert [r["path"] for r in results] == paths
+    assert server.n_connections <= 4
+
+
+def test_overloaded_responses_are_retried(server):
+    requester = AsyncRequester(2, backoff_factor=0.01)
+    try:
+        results = requester.send_async_requests([url(server, "/flaky"), url(server, "/ok")])
+    finally:
+        requester.close()
+    assert results == [{"path": "/flaky"}, {"path": "/ok"}]
+    assert server.n_requests["/flaky"] == 3
@@ -0,0 +1,71 @@
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+from dummy_agent.cell_matching import GreedyCellSolver, OptimalCellSolver, match_cells, partition_cells, \
+    round_arrays, round_context, solve_cell
+
+MAX_WAIT = 900
+
+
+def sparse_etas(rng, n_rows, n_cols, density):
+    rows, cols = np.nonzero(rng.uniform(size=(n_rows, n_cols)) < density)
+    T = rng.uniform(0, 1200, len(rows)).astype(np.float32)
+    T[rng.uniform(size=len(T)) < 0.05] = 0      # Held pairs with a zero ETA
+    return csr_matrix((T, (rows, cols)), shape=(n_rows, n_cols))
+
+
+def random_round(seed, n_vehicles=60, n_requests=80, n_cells=25):
+    rng = np.random.RandomState(seed)
+    arrays = round_arrays(sparse_etas(rng, n_vehicles, n_requests, 0.6),
+                          sparse_etas(rng, n_requests, n_requests, 0.6),
+                          sparse_etas(rng, n_requests, n_requests, 0.8),
+                          40.7 + rng.uniform(0, 0.05, (n_vehicles, 2)), 40.7 + rng.uniform(0, 0.05, (n_requests, 2)))
+    requests = rng.permutation(n_requests)
+    cells = []
+    for ridx in np.array_split(requests, n_cells):
+        # Neighbouring cells share candidate vehicles
+        vidx = rng.choice(n_vehicles, size=int(rng.randint(3, 12)), replace=False)
+        cells.append((ridx.tolist(), vidx.tolist(), rng.uniform(size=len(vidx)) < 0.2))
+    return arrays, cells
+
+
+# Solves the cells strictly one after the other
+def one_by_one(solver, arrays, cells):
+    context = round_context(arrays)
+    assigned, blocked = defaultdict(list), set()
+    results = []
+    for ridx, vidx, full in cells:
+        assignments, cleared = solve_cell(solver, context, (ridx, vidx, [assigned[vi] for vi in vidx],
+                                                            [vi in blocked for vi in vidx], full))
+        blocked.update(vidx[vi] for vi in cleared)
+        for vi, ri, _, _ in assignments:
+            assigned[vidx[vi]].append(ridx[ri])
+        results.append(assignments)
+    return results
+
+
+def test_waves_share_no_vehicle():
+    _, cells = random_round(0)
+    waves = partition_cells([vidx for _, vidx, _ in cells], 60)
+    assert sorted(i for wave in waves for i in wave) == list(range(len(cells)))
+    assert len(waves) > 1
+    wave_of = {i: w for w, wave in enumerate(waves) for i in wave}
+    for i, (_, vidx, _) in enumerate(cells):
+        for j in range(i):
+            if set(vidx) & set(cells[j][1]):
+                assert wave_of[j] < wave_of[i]
+
+
+def test_workers_match_the_cells_one_by_one():
+    solvers = [GreedyCellSolver(MAX_WAIT), OptimalCellSolver(MAX_WAIT, 3, 20)]
+    rounds = [random_round(seed) for seed in range(3)]
+    expected = [[one_by_one(solver, *r) for r in rounds] for solver in solvers]
+    assert any(len(a) > 0 for e in expected for cells in e for a in cells)
+
+    for solver, e in zip(solvers, expected):
+        assert [match_cells(solver, *r) for r in rounds] == e
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for solver, e in zip(solvers, expected):
+            assert [match_cells(solver, *r, executor=executor, n_workers=2) for r in rounds] == e
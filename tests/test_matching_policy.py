@@ -0,0 +1,44 @@
+import numpy as np
+from dummy_agent.cell_matching import min_cost_assignment
+
+MAX_COST = 10
+
+
+def both_branches(T):
+    dense = min_cost_assignment(T, MAX_COST)
+    sparse = min_cost_assignment(T, MAX_COST, n_nearest=T.shape[1])
+    return [sorted(zip(*map(np.ndarray.tolist, solution))) for solution in (dense, sparse)]
+
+
+def test_branches_agree():
+    rng = np.random.RandomState(0)
+    for n_rows, n_cols in [(5, 11), (8, 8), (12, 5)]:
+        T = rng.uniform(0, 15, size=(n_rows, n_cols)).astype(np.float32)
+        dense, sparse = both_branches(T)
+        assert dense == sparse
+        assert all(T[r, c] <= MAX_COST for r, c in dense)
+
+
+def test_infeasible_rows_are_left_out():
+    T = np.array([[1, 4, 30],
+                  [20, 25, 30],
+                  [2, 3, 9],
+                  [11, 12, 13]], dtype=np.float32)
+    dense, sparse = both_branches(T)
+    assert dense == sparse == [(0, 0), (2, 1)]
+
+
+def test_most_rows_are_served_before_the_cost_is_minimized():
+    # Serving both rows costs 9 + 9, more than 1 for row 0 alone
+    T = np.array([[1, 9],
+                  [9, 20]], dtype=np.float32)
+    dense, sparse = both_branches(T)
+    assert dense == sparse == [(0, 1), (1, 0)]
+
+
+def test_zero_costs_and_empty_matrices():
+    T = np.zeros((3, 2), dtype=np.float32)
+    dense, sparse = both_branches(T)
+    assert len(dense) == len(sparse) == 2
+    assert both_branches(np.empty((0, 4), dtype=np.float32)) == [[], []]
+    assert both_branches(np.empty((3, 0), dtype=np.float32)) == [[], []]
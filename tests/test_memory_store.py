@@ -0,0 +1,48 @@
+import numpy as np
+from dqn_agent.memory_store import MemoryShardWriter, iter_shards, list_shards
+
+N_MAPS, SHAPE = 2, (3, 4)
+
+
+def write_run(directory, t0, n_shards):
+    writer = MemoryShardWriter(str(directory), N_MAPS, SHAPE, shard_size=2)
+    for i in range(n_shards):
+        t = t0 + i
+        writer.append(t, 1, 2, 0, 1, t + 1, 1, 3, 0.5)
+        writer.append(t, 2, 2, 1, 0, t + 1, 3, 2, 1.5)
+        writer.add_snapshot(t, np.full((N_MAPS,) + SHAPE, t), (i, 0.1))
+    writer.flush()
+
+
+def loaded_times(directory):
+    times = []
+    for sd, sars in iter_shards(str(directory)):
+        times.extend(sars['t'].tolist())
+    return times
+
+
+def test_only_the_last_run_is_loaded(tmp_path):
+    write_run(tmp_path, 100, 3)
+    assert loaded_times(tmp_path) == [100, 100, 101, 101, 102, 102]
+
+    write_run(tmp_path, 200, 2)
+    assert loaded_times(tmp_path) == [200, 200, 201, 201]
+    sd, _ = next(iter_shards(str(tmp_path)))
+    assert sd['t'].tolist() == [200]
+    assert np.all(sd['maps'][0] == 200)
+
+
+def test_shards_listed_before_the_next_run_writes(tmp_path):
+    write_run(tmp_path, 100, 2)
+    shards = iter_shards(str(tmp_path))
+    write_run(tmp_path, 200, 1)
+    assert [sars['t'].tolist() for _, sars in shards] == [[100, 100], [101, 101]]
+
+
+def test_older_runs_are_removed(tmp_path):
+    write_run(tmp_path, 100, 2)
+    write_run(tmp_path, 200, 2)
+    write_run(tmp_path, 300, 1)
+    assert len(list(tmp_path.glob("sars_*.npy"))) == 3
+    assert len(list_shards(str(tmp_path))) == 1
+    assert loaded_times(tmp_path) == [300, 300]
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import polyline
+import pytest
+from common.geoutils import great_circle_distance
+from config.settings import MIN_LAT, MIN_LON, DELTA_LAT, DELTA_LON
+from simulator.services.osrm_engine import OSRMEngine
+from simulator.services.routing_service import RoutingEngine
+from simulator.models.vehicle.vehicle_repository import VehicleRepository
+from dummy_agent.matching_policy import GreedyMatchingPolicy, OptimalMatchingPolicy
+
+SPEED = 8.0
+
+
+def table_latlons(url):
+    return np.array(polyline.decode(url[url.index("polyline(") + 9:url.index(")")], 5))
+
+
+class StubRequester(object):
+    """Answers OSRM table requests from the source (the first coordinate) with great circle durations"""
+    def __init__(self):
+        self.urls = []
+
+    def send_async_requests(self, urllist):
+        self.urls.extend(urllist)
+        return [self.table(url) for url in urllist]
+
+    @staticmethod
+    def table(url):
+        assert url.endswith("?sources=0")
+        latlons = table_latlons(url)
+        d = great_circle_distance(latlons[0, 0], latlons[0, 1], latlons[:, 0], latlons[:, 1])
+        return {"durations": [(d / SPEED).tolist()]}
+
+
+@pytest.fixture
+def engine():
+    engine = OSRMEngine(n_threads=1)
+    engine.async_requester = StubRequester()
+    yield engine
+    RoutingEngine.engine = None
+
+
+def random_latlon(rng, n):
+    return np.c_[MIN_LAT + DELTA_LAT * rng.uniform(10, 20, n), MIN_LON + DELTA_LON * rng.uniform(10, 20, n)]
+
+
+def test_sparse_pairs_are_the_dense_pairs_within_max_distance(engine):
+    rng = np.random.RandomState(0)
+    origins, destins = random_latlon(rng, 30), random_latlon(rng, 20)
+    rows, cols, T, d = engine.eta_many_to_many(origins, destins, max_distance=2000, sparse=True)
+    dense_T, dense_d = engine.eta_many_to_many(origins, destins, max_distance=2000)
+
+    within = dense_d < 2000
+    assert 0 < len(rows) < within.size
+    assert np.array_equal(np.c_[rows, cols], np.argwhere(within))
+    assert np.array_equal(d, dense_d[rows, cols])
+    assert np.allclose(T, d / SPEED, atol=1)
+    assert np.array_equal(dense_T[rows, cols], T) and np.all(np.isinf(dense_T[~within]))
+    # One table request per origin with destinations in range
+    assert len(engine.async_requester.urls) == 2 * len(set(rows))
+
+
+@pytest.mark.parametrize("policy", [GreedyMatchingPolicy, OptimalMatchingPolicy])
+def test_match_rs_with_osrm(engine, policy):
+    rng = np.random.RandomState(1)
+    RoutingEngine.engine = engine
+    VehicleRepository.init()
+    for vid, latlon in enumerate(random_latlon(rng, 40)):
+        VehicleRepository.populate(vid, tuple(latlon), 1)
+        VehicleRepository.get(vid).state.idle_duration = 60
+    origins, destins = random_latlon(rng, 30), random_latlon(rng, 30)
+    requests = pd.DataFrame({"origin_lat": origins[:, 0], "origin_lon": origins[:, 1],
+                             "destination_lat": destins[:, 0], "destination_lon": destins[:, 1]},
+                            index=pd.Index(np.arange(100, 130), name="id"))
+
+    commands = policy().match_RS(0, VehicleRepository.get_states(), requests)
+    assert len(commands) > 0 and engine.async_requester.urls
+    customers = [c["customer_id"] for c in commands]
+    assert len(customers) == len(set(customers))
+    vehicles = VehicleRepository.get_states()
+    for c in commands:
+        v = vehicles.loc[c["vehicle_id"]]
+        r = requests.loc[c["customer_id"]]
+        d = great_circle_distance(v.lat, v.lon, r.origin_lat, r.origin_lon)
+        assert d < 5000 and c["duration"] >= d / SPEED - 1
+
+
+def test_repeated_pairs_are_read_from_the_cache(tmp_path):
+    rng = np.random.RandomState(2)
+    origins, destins = random_latlon(rng, 30), random_latlon(rng, 20)
+    cache_path = str(tmp_path / "osrm_cache.sqlite3")
+    engine = OSRMEngine(n_threads=1, cache_path=cache_path)
+    engine.async_requester = StubRequester()
+    rows, cols, T, _ = engine.eta_many_to_many(origins, destins, max_distance=2000, sparse=True)
+    assert len(engine.async_requester.urls) == len(set(rows))
+
+    # A later run on the same file requests nothing for the same pairs, and only the new destination otherwise
+    engine = OSRMEngine(n_threads=1, cache_path=cache_path)
+    engine.async_requester = StubRequester()
+    assert np.array_equal(engine.eta_many_to_many(origins, destins, max_distance=2000, sparse=True)[2], T)
+    assert engine.async_requester.urls == []
+
+    destins = np.r_[destins, origins[rows[:1]] + 0.001]
+    new_rows, new_cols, new_T, _ = engine.eta_many_to_many(origins, destins, max_distance=2000, sparse=True)
+    assert np.array_equal(new_T[new_cols < len(destins) - 1], T)
+    urls = engine.async_requester.urls
+    assert len(urls) == np.sum(new_cols == len(destins) - 1) > 0
+    assert all(len(table_latlons(url)) == 2 for url in urls)
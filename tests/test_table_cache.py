@@ -0,0 +1,54 @@
+import multiprocessing
+import numpy as np
+import pytest
+from common import table_cache
+
+N_PROCESSES = 4
+
+
+def build_table(path, barrier, value):
+    def build():
+        barrier.wait()          # All the processes write at the same time
+        return np.full(2_000_000, value, dtype=np.int64)
+    table_cache.load_or_build(path, build)
+
+
+def build_tables(path, barrier, value):
+    def build():
+        barrier.wait()
+        return {'a': np.full(1_000_000, value, dtype=np.int64), 'b': np.arange(value)}
+    table_cache.load_or_build_many(path, build)
+
+
+@pytest.mark.parametrize("target, name", [(build_table, "table.npy"), (build_tables, "tables.npz")])
+def test_concurrent_builds_leave_one_complete_file(tmp_path, target, name):
+    path = str(tmp_path / name)
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(N_PROCESSES)
+    processes = [ctx.Process(target=target, args=(path, barrier, i + 1)) for i in range(N_PROCESSES)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert all(p.exitcode == 0 for p in processes)
+    assert [f.name for f in tmp_path.iterdir()] == [name]
+
+    if name.endswith(".npy"):
+        table = table_cache.load_or_build(path, None)
+        assert len(table) == 2_000_000 and np.all(table == table[0])
+    else:
+        tables = table_cache.load_or_build_many(path, None)
+        assert np.all(tables['a'] == tables['a'][0])
+        assert np.array_equal(tables['b'], np.arange(tables['a'][0]))
+
+
+def test_failed_write_leaves_no_file(tmp_path):
+    path = str(tmp_path / "table.npy")
+
+    def write(f):
+        f.write(b"partial")
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        table_cache.write_atomically(path, write)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from novelties import status_codes
+from simulator.models.vehicle.fleet_store import FleetStore
+from simulator.models.vehicle.vehicle_repository import VehicleRepository
+
+
+@pytest.fixture
+def fleet():
+    VehicleRepository.init()
+    for vid in range(10):
+        VehicleRepository.populate(vid, (40.7 + vid * 1e-3, -74.0), 1)
+    yield VehicleRepository.fleet
+    VehicleRepository.init()
+
+
+def test_static_columns_are_read_only_views(fleet):
+    states = VehicleRepository.get_states()
+    assert list(states.index) == list(range(10))
+    for name in FleetStore.static_columns - {'id'}:
+        assert np.shares_memory(states[name].values, fleet.view(name))
+    with pytest.raises(ValueError):
+        states.loc[[1, 2], "max_capacity"] = 0
+    assert np.all(fleet.view("max_capacity") > 0)
+
+
+def test_other_columns_are_a_snapshot(fleet):
+    states = VehicleRepository.get_states()
+    for name in set(FleetStore.state_columns) - FleetStore.static_columns:
+        assert not np.shares_memory(states[name].values, fleet.view(name))
+
+    # As Central_Agent.update_vehicles does
+    states.loc[[1, 2], "status"] = status_codes.V_ASSIGNED
+    assert np.all(fleet.view("status") == status_codes.V_IDLE)
+    VehicleRepository.get(3).state.current_capacity = 2
+    assert states.loc[3, "current_capacity"] == 0
+    assert VehicleRepository.get_states().loc[3, "current_capacity"] == 2